@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select
+from app.database import AsyncSessionLocal, AIResponseCache
+from app import metrics, tracing
+
+# -----------------------------
+# AI response cache
+# -----------------------------
+# Content-addressed cache for structured AI output (tasker, reader).
+# A small in-process LRU sits in front of the ai_response_cache table so
+# repeated inputs skip Gemini entirely, even across restarts.
+
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "1") == "1"
+AI_CACHE_TTL_SECONDS = int(os.getenv("AI_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+AI_CACHE_MEMORY_ENTRIES = int(os.getenv("AI_CACHE_MEMORY_ENTRIES", "512"))
+AI_CACHE_MAX_ROWS = int(os.getenv("AI_CACHE_MAX_ROWS", "10000"))
+# Run table eviction once every N writes instead of on every insert
+AI_CACHE_PRUNE_EVERY = int(os.getenv("AI_CACHE_PRUNE_EVERY", "100"))
+
+
+def normalize_input(text: str):
+    """Collapses whitespace so trivially re-formatted pastes share a key."""
+    return " ".join(text.split())
+
+
+def make_cache_key(module: str, model: str, system_instruction: str, input_text: str):
+    """Hash of everything that determines the AI output."""
+    material = json.dumps(
+        [module, model, system_instruction, normalize_input(input_text)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, ttl_seconds=AI_CACHE_TTL_SECONDS, memory_entries=AI_CACHE_MEMORY_ENTRIES,
+                 max_rows=AI_CACHE_MAX_ROWS, prune_every=AI_CACHE_PRUNE_EVERY):
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+
+        self._memory = OrderedDict()   # key -> (expires_at monotonic, value)
+        self._writes = 0
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    # --- In-process LRU ---
+    def _memory_get(self, key):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_set(self, key, value, ttl_seconds):
+        self._memory[key] = (time.monotonic() + ttl_seconds, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    # --- SQLite table ---
+    async def _db_get(self, key):
+        async with AsyncSessionLocal() as db:
+            row = await db.get(AIResponseCache, key)
+            if row is None:
+                return None
+            remaining = (row.expires_at - datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                await db.delete(row)
+                await db.commit()
+                return None
+            return json.loads(row.response), remaining
+
+    async def _db_set(self, key, module, value, prune):
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            await db.merge(AIResponseCache(
+                key=key,
+                module=module,
+                response=json.dumps(value, ensure_ascii=False),
+                created_at=now,
+                expires_at=now + timedelta(seconds=self.ttl_seconds)
+            ))
+            if prune:
+                await db.flush()
+                await self._db_prune(db, now)
+            await db.commit()
+
+    async def _db_prune(self, db, now):
+        """Drops expired rows, then the oldest rows beyond max_rows."""
+        await db.execute(delete(AIResponseCache).where(AIResponseCache.expires_at <= now))
+        newest = (
+            select(AIResponseCache.key)
+            .order_by(AIResponseCache.created_at.desc())
+            .limit(self.max_rows)
+        )
+        await db.execute(delete(AIResponseCache).where(AIResponseCache.key.not_in(newest)))
+
+    # --- Public API ---
+    async def get(self, key):
+        """Returns the cached value for key, or None on a miss."""
+        if not AI_CACHE_ENABLED:
+            return None
+
+        with tracing.span("ai_cache.get") as span:
+            value = await self._get(key)
+            span.set(hit=value is not None)
+            return value
+
+    async def _get(self, key):
+        value = self._memory_get(key)
+        if value is not None:
+            self.memory_hits += 1
+            metrics.ai_cache_lookups_total.inc(result="memory_hit")
+            return value
+
+        try:
+            found = await self._db_get(key)
+        except Exception as e:
+            print(f"Response cache read error: {e}")
+            found = None
+
+        if found is None:
+            self.misses += 1
+            metrics.ai_cache_lookups_total.inc(result="miss")
+            return None
+
+        value, remaining = found
+        self.db_hits += 1
+        metrics.ai_cache_lookups_total.inc(result="db_hit")
+        self._memory_set(key, value, remaining)
+        return value
+
+    async def set(self, key, module, value):
+        """Stores a successful AI result. Never raises."""
+        if not AI_CACHE_ENABLED:
+            return
+
+        self._memory_set(key, value, self.ttl_seconds)
+        self._writes += 1
+        prune = self._writes % self.prune_every == 0
+        try:
+            await self._db_set(key, module, value, prune)
+        except Exception as e:
+            print(f"Response cache write error: {e}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+
+response_cache = ResponseCache()
+
+metrics.Gauge(
+    "clarity_ai_cache_hit_ratio", "Share of response cache lookups served from the cache.",
+    lambda: response_cache.stats()["hit_ratio"]
+)
@@ -0,0 +1,200 @@
+import os
+import asyncio
+from sqlalchemy import select, update
+from app import gemini, tracing
+from app.gemini import model_url
+from app.routing import route_model
+from app.metrics import chat_context_tokens, chat_summaries_total
+from app.database import AsyncSessionLocal, ChatSession, ChatMessage
+
+# -----------------------------
+# Conversation context
+# -----------------------------
+# Gives Buddy a memory without letting requests grow with the session.
+# A chat request carries: the system instruction, a rolling summary of
+# older turns (stored on the ChatSession), the most recent messages that
+# fit the token budget, and the new user message. After each reply a
+# background task folds turns that no longer fit into the summary, one
+# Gemini call per batch of turns, so request size stays flat however long
+# the conversation gets. Tokens are estimated at ~4 characters each.
+# Canned fallback replies (ChatMessage.fallback) are left out of both.
+
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "4000"))
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "2000"))
+CHAT_RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", "30"))
+CHAT_SUMMARY_WORDS = int(os.getenv("CHAT_SUMMARY_WORDS", "200"))
+
+API_KEY = os.getenv("GEMINI_API_KEY", "")
+
+SENDER_ROLES = {"user": "user", "ai": "model"}
+SENDER_NAMES = {"user": "User", "ai": "Buddy"}
+
+
+def estimate_tokens(text: str):
+    return len(text or "") // 4 + 1
+
+
+class ChatContext:
+    def __init__(self, summary=None, history=()):
+        self.summary = summary
+        self.history = list(history)   # [(sender, text), ...] oldest first
+
+    def contents(self, user_text: str):
+        """generateContent `contents`: recent turns, then the new message."""
+        turns = [
+            {"role": SENDER_ROLES.get(sender, "user"), "parts": [{"text": text}]}
+            for sender, text in self.history
+        ]
+        turns.append({"role": "user", "parts": [{"text": user_text}]})
+        return turns
+
+
+async def build_chat_context(session_id: str, user_text: str, system_instruction: str):
+    """
+    Loads the summary and the newest messages that fit CHAT_CONTEXT_TOKENS
+    alongside the system instruction and the new message. Call it before
+    the new message is stored.
+    """
+    async with AsyncSessionLocal() as db:
+        session = await db.get(ChatSession, session_id)
+        if session is None:
+            return ChatContext()
+        summary, summarized_until = session.summary, session.summary_message_id or 0
+
+        # Newest first over ix_chat_messages_session_id_created_at
+        result = await db.execute(
+            select(ChatMessage.sender, ChatMessage.message_text)
+            .where(
+                ChatMessage.session_id == session_id,
+                ChatMessage.id > summarized_until,
+                ChatMessage.fallback.is_(False)
+            )
+            .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+            .limit(CHAT_RECENT_MESSAGES)
+        )
+        rows = result.all()
+
+    used = estimate_tokens(system_instruction) + estimate_tokens(user_text)
+    if summary:
+        used += estimate_tokens(summary)
+
+    history = []
+    for sender, text in rows:
+        cost = estimate_tokens(text)
+        if used + cost > CHAT_CONTEXT_TOKENS:
+            break
+        history.append((sender, text))
+        used += cost
+    history.reverse()
+
+    chat_context_tokens.observe(used)
+    return ChatContext(summary, history)
+
+
+# --- Rolling summary ---
+
+_summarizing = {}   # session_id -> task, at most one summary update per session
+
+
+def schedule_summary(session_id: str):
+    """Folds old turns into the session summary in the background (after a reply)."""
+    task = _summarizing.get(session_id)
+    if task is not None and not task.done():
+        return
+    task = tracing.create_background_task(_update_summary(session_id))
+    _summarizing[session_id] = task
+    # A finishing older task must not evict a newer one
+    task.add_done_callback(lambda t: _summarizing.pop(session_id, None) if _summarizing.get(session_id) is t else None)
+
+
+async def stop_summaries():
+    tasks = list(_summarizing.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _update_summary(session_id: str):
+    async with AsyncSessionLocal() as db:
+        session = await db.get(ChatSession, session_id)
+        if session is None:
+            return
+        summary, summarized_until = session.summary, session.summary_message_id or 0
+
+        result = await db.execute(
+            select(ChatMessage.id, ChatMessage.sender, ChatMessage.message_text)
+            .where(
+                ChatMessage.session_id == session_id,
+                ChatMessage.id > summarized_until,
+                ChatMessage.fallback.is_(False)
+            )
+            .order_by(ChatMessage.created_at, ChatMessage.id)
+        )
+        rows = result.all()
+
+    total = sum(estimate_tokens(text) for _, _, text in rows)
+    if total <= CHAT_HISTORY_TOKENS:
+        return
+
+    # Fold the oldest turns until the rest fits half the history budget,
+    # so the summary is rewritten every few turns rather than every turn
+    to_fold = []
+    for row in rows:
+        if total <= CHAT_HISTORY_TOKENS // 2:
+            break
+        to_fold.append(row)
+        total -= estimate_tokens(row[2])
+
+    new_summary = await _summarize(summary, [(sender, text) for _, sender, text in to_fold])
+    if new_summary is None:
+        chat_summaries_total.inc(outcome="failed")
+        return
+
+    async with AsyncSessionLocal() as db:
+        # Only if nobody else moved the summary on in the meantime
+        unchanged = (
+            ChatSession.summary_message_id == summarized_until if summarized_until
+            else ChatSession.summary_message_id.is_(None)
+        )
+        await db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id, unchanged)
+            .values(summary=new_summary, summary_message_id=to_fold[-1][0])
+        )
+        await db.commit()
+    chat_summaries_total.inc(outcome="updated")
+
+
+async def _summarize(summary, turns):
+    """One Gemini call merging `turns` into the previous summary. None on failure."""
+    if not API_KEY:
+        return None
+
+    transcript = "\n".join(f"{SENDER_NAMES.get(sender, sender)}: {text}" for sender, text in turns)
+    prompt = (
+        f"Summary so far:\n{summary or '(none)'}\n\n"
+        f"Newer messages:\n{transcript}\n\n"
+        "Write the updated summary."
+    )
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "systemInstruction": {"parts": [{"text": (
+            "You keep a running summary of a conversation between a user and Buddy, "
+            "an ADHD support companion. Keep facts about the user, their goals, "
+            "open tasks and anything Buddy promised. Plain text, at most "
+            f"{CHAT_SUMMARY_WORDS} words."
+        )}]}
+    }
+
+    # CHAT_SUMMARY_MODEL, if set, is the chatbot_summary route (routing.py)
+    model = route_model("chatbot_summary", len(prompt))
+    response = await gemini.generate_content("chatbot_summary", f"{model_url(model)}?key={API_KEY}", payload)
+    if response is None:
+        return None
+    try:
+        result = response.json()
+        text = result["candidates"][0]["content"]["parts"][0]["text"].strip()
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        print(f"API Error: unreadable summary response: {e}")
+        return None
+    return text or None
@@ -0,0 +1,154 @@
+import os
+import asyncio
+from datetime import datetime
+from app.database import AsyncSessionLocal, ChatMessage
+from app import metrics
+
+# -----------------------------
+# Write-behind chat persistence
+# -----------------------------
+# ChatMessage inserts from all sessions go through one queue and are
+# committed together, so a burst of messages costs one fsync instead of
+# one per message. CHAT_WRITE_MODE picks the durability trade-off:
+#   sync    - every message is committed on its own before returning
+#   batched - group commit: the caller waits until its batch is committed;
+#             a batch is whatever queued up during the previous commit,
+#             flushed as soon as no more writes are arriving (at most
+#             CHAT_FLUSH_INTERVAL_MS after its first row)
+#   async   - fire and forget: the caller returns once the row is queued
+#             (queued rows are lost if the process crashes)
+
+CHAT_WRITE_MODE = os.getenv("CHAT_WRITE_MODE", "batched")
+CHAT_BATCH_SIZE = int(os.getenv("CHAT_BATCH_SIZE", "64"))
+CHAT_FLUSH_INTERVAL = float(os.getenv("CHAT_FLUSH_INTERVAL_MS", "50")) / 1000
+CHAT_QUEUE_MAX = int(os.getenv("CHAT_QUEUE_MAX", "10000"))
+
+_STOP = object()
+
+
+class ChatMessageWriter:
+    def __init__(self, mode=CHAT_WRITE_MODE, batch_size=CHAT_BATCH_SIZE,
+                 flush_interval=CHAT_FLUSH_INTERVAL, queue_max=CHAT_QUEUE_MAX):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_max = queue_max
+
+        self._queue = None
+        self._task = None
+        self._stopping = False
+
+        self.batches = 0
+        self.rows = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.mode == "sync" or self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_max)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes everything still queued and stops the background task."""
+        if not self.running:
+            return
+        # Writes from here on commit directly, nothing is queued behind _STOP
+        self._stopping = True
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def write(self, session_id: str, sender: str, message_text: str, fallback: bool = False):
+        """Persists one ChatMessage according to the configured write mode."""
+        row = {
+            "session_id": session_id,
+            "sender": sender,
+            "message_text": message_text,
+            "fallback": fallback,
+            "created_at": datetime.utcnow(),
+        }
+
+        # Without the background task (sync mode, scripts, tests) write directly
+        if self.mode == "sync" or not self.running or self._stopping:
+            await self._commit([row])
+            return
+
+        done = asyncio.get_running_loop().create_future() if self.mode == "batched" else None
+        await self._queue.put((row, done))
+        if done is not None:
+            await done
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+
+            # Take what is already queued. While writes keep arriving, let
+            # their callers run and take those too, until the batch is full
+            # or the flush interval has passed; a lone write goes right away.
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            arriving = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    if not arriving or loop.time() >= deadline:
+                        break
+                    arriving = False
+                    await asyncio.sleep(0)
+                    continue
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                arriving = True
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        rows = [row for row, _ in batch]
+        try:
+            await self._commit(rows)
+            results = [None] * len(batch)
+        except Exception as e:
+            # One bad row (e.g. a deleted session) must not drop the others
+            print(f"Chat batch write failed, retrying rows one by one: {e}")
+            results = []
+            for row in rows:
+                try:
+                    await self._commit([row])
+                    results.append(None)
+                except Exception as row_error:
+                    print(f"Chat message write failed: {row_error}")
+                    results.append(row_error)
+
+        for (_, done), error in zip(batch, results):
+            if done is None or done.done():
+                continue
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+
+    async def _commit(self, rows):
+        async with AsyncSessionLocal() as db:
+            db.add_all([ChatMessage(**row) for row in rows])
+            await db.commit()
+        self.batches += 1
+        self.rows += len(rows)
+
+
+chat_writer = ChatMessageWriter()
+
+metrics.Gauge(
+    "clarity_chat_write_queue_depth", "Chat messages waiting in the write-behind queue.",
+    lambda: chat_writer._queue.qsize() if chat_writer._queue is not None else 0
+)
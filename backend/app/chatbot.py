@@ -1,65 +1,42 @@
 import uuid
-import asyncio
-import httpx
+import json
 import os
+import anyio
+import httpx
 from fastapi import APIRouter, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 
 # Import existing models and DB config from your project
-from app.database import SessionLocal, ChatSession, ChatMessage
+from app import gemini, context_cache
+from app.gemini import model_url
+from app.routing import route_model, record_usage
+from app import metrics
+from app.metrics import ai_fallback_total
+from app.prompts import build_system_instruction
+from app.chat_writer import chat_writer
+from app.greetings import GreetingPrefetcher
+from app.chat_context import build_chat_context, schedule_summary
+from app.rate_limit import limit_chat, limit_sessions
+from app.database import AsyncSessionLocal, ChatSession, get_db
 
 router = APIRouter()
 
 # --- Configuration ---
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
-# Directory to source chatbot-specific prompts
-PROMPTS_DIR = os.path.join("prompts", "chatbot")
-COMMON_PROMPTS_FILE = os.path.join("prompts", "common.txt")
-
 # Retrieve API Key from environment variables loaded in main.py
 API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def load_custom_prompts():
-    """Reads prompts/common.txt and all .txt files from prompts/chatbot directory."""
-    custom_prompts = []
-    
-    # Load common prompts first
-    if os.path.exists(COMMON_PROMPTS_FILE):
-        try:
-            with open(COMMON_PROMPTS_FILE, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                if content:
-                    custom_prompts.append(content)
-        except Exception as e:
-            print(f"Error reading common prompts file: {e}")
-    
-    # Load module-specific prompts
-    if os.path.exists(PROMPTS_DIR) and os.path.isdir(PROMPTS_DIR):
-        for filename in os.listdir(PROMPTS_DIR):
-            if filename.endswith(".txt"):
-                file_path = os.path.join(PROMPTS_DIR, filename)
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read().strip()
-                        if content:
-                            custom_prompts.append(content)
-                except Exception as e:
-                    print(f"Error reading prompt file {filename}: {e}")
-    return "\n\n".join(custom_prompts)
+# Canned replies shown when Gemini gave no answer. They are stored with
+# fallback=True, so they are never sent back to the model as its own turns.
+NO_API_KEY_REPLY = "Configuration Error: GEMINI_API_KEY is missing from the environment."
+UNAVAILABLE_REPLY = "The assistant is temporarily unavailable. Please try again later."
+EMPTY_REPLY = "I'm sorry, I couldn't formulate a response."
+FALLBACK_REPLIES = (NO_API_KEY_REPLY, UNAVAILABLE_REPLY, EMPTY_REPLY)
 
 # 1) START CHAT: Generate session and return session_id
-@router.post("/api/chat/start")
-async def start_chat(db: Session = Depends(get_db)):
+@router.post("/api/chat/start", dependencies=[Depends(limit_sessions)])
+async def start_chat(db: AsyncSession = Depends(get_db)):
     """Creates a new chat session. Called by Flutter to start a conversation."""
     session_id = str(uuid.uuid4())
     
@@ -71,7 +48,10 @@ async def start_chat(db: Session = Depends(get_db)):
     )
     
     db.add(new_session)
-    db.commit()
+    await db.commit()
+
+    # The app asks for the greeting right away, start generating it now
+    greetings.prefetch(session_id)
     
     return {"session_id": session_id}
 
@@ -79,102 +59,225 @@ async def start_chat(db: Session = Depends(get_db)):
 
 # 2.5) GET INITIAL GREETING: Generate personalized greeting based on prompts and user profile
 @router.get("/api/chat/greeting/{session_id}")
-async def get_initial_greeting(session_id: str, db: Session = Depends(get_db)):
-    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+async def get_initial_greeting(session_id: str):
+    # Short read phase; the connection is back in the pool before the AI call
+    async with AsyncSessionLocal() as db:
+        session = await db.get(ChatSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Generate a personalized greeting using the AI
-    greeting_prompt = "This is the start of a new conversation. Please greet the user warmly and introduce yourself as Buddy, their ADHD support companion. Keep it brief, friendly, and encouraging. Make the user feel comfortable and supported."
-    
-    greeting = await call_gemini_api(greeting_prompt)
+    # Personalized greeting, usually already generated since start_chat
+    greeting = await greetings.get(session_id)
+    if greeting is None:
+        greeting = fallback_reply()
     
     return {"greeting": greeting}
 
+# Each DB phase below is its own short transaction: no pooled connection
+# is held while a handler is waiting on Gemini. Message inserts go through
+# the write-behind chat_writer, which batches commits across sessions.
+async def _save_user_message(session_id: str, user_text: str):
+    """Checks the session exists and stores the user's message."""
+    async with AsyncSessionLocal() as db:
+        session = await db.get(ChatSession, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    await chat_writer.write(session_id, "user", user_text)
+
+async def _save_ai_message(session_id: str, ai_reply: str):
+    await chat_writer.write(session_id, "ai", ai_reply, fallback=ai_reply in FALLBACK_REPLIES)
+    # Older turns that no longer fit the context budget go into the summary
+    schedule_summary(session_id)
+
 # 3) HANDLE CHAT MESSAGE: Logic, AI Call, and Storage
 @router.post("/api/chat/message")
-async def handle_message(request: Request, db: Session = Depends(get_db)):
+async def handle_message(request: Request):
     data = await request.json()
     session_id = data.get("session_id")
     user_text = data.get("message")
 
     if not session_id or not user_text:
         raise HTTPException(status_code=400, detail="Missing session_id or message")
+    limit_chat(request, session_id)
 
-    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+    # Conversation so far, read before the new message is stored
+    context = await build_chat_context(session_id, user_text, chat_system_instruction())
 
     # Save User Message to SQLite
-    user_msg = ChatMessage(
-        session_id=session_id,
-        sender="user",
-        message_text=user_text,
-        created_at=datetime.utcnow()
-    )
-    db.add(user_msg)
-    db.commit()
+    await _save_user_message(session_id, user_text)
 
     # Call Gemini AI (Backend only)
-    ai_reply = await call_gemini_api(user_text)
+    ai_reply = await call_gemini_api(user_text, context)
 
     # Save AI Reply to SQLite
-    ai_msg = ChatMessage(
-        session_id=session_id,
-        sender="ai",
-        message_text=ai_reply,
-        created_at=datetime.utcnow()
-    )
-    db.add(ai_msg)
-    db.commit()
+    await _save_ai_message(session_id, ai_reply)
 
     return {"reply": ai_reply}
 
-async def call_gemini_api(user_prompt: str):
-    """Calls Gemini API with initial instructions and retry logic."""
-    if not API_KEY:
-        return "Configuration Error: GEMINI_API_KEY is missing from the environment."
+# 3.5) STREAM CHAT MESSAGE: Same as above, but forwards tokens as Server-Sent Events
+@router.post("/api/chat/message/stream")
+async def handle_message_stream(request: Request):
+    data = await request.json()
+    session_id = data.get("session_id")
+    user_text = data.get("message")
+
+    if not session_id or not user_text:
+        raise HTTPException(status_code=400, detail="Missing session_id or message")
+    limit_chat(request, session_id)
+
+    # Conversation so far, read before the new message is stored
+    context = await build_chat_context(session_id, user_text, chat_system_instruction())
 
+    # Save User Message to SQLite
+    await _save_user_message(session_id, user_text)
+
+    async def event_stream():
+        chunks = []
+        try:
+            async for text in stream_gemini_api(user_text, context):
+                chunks.append(text)
+                yield f"data: {json.dumps({'delta': text})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'reply': ''.join(chunks)})}\n\n"
+        finally:
+            # Runs on completion and on client disconnect, so a partial reply is kept too
+            # (shielded: the response task may already be cancelled here)
+            if chunks:
+                with anyio.CancelScope(shield=True):
+                    await _save_ai_message(session_id, "".join(chunks))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def chat_system_instruction():
+    """Buddy's system instructions."""
     # --- BASE SYSTEM INSTRUCTIONS ---
     base_instruction = (
         "You are 'Buddy', a ADHD person helper"
     )
 
     # --- DYNAMIC PROMPT SOURCING ---
-    # Load additional instructions from text files in the models/chatbot directory
-    custom_context = load_custom_prompts()
-    
-    full_system_instruction = base_instruction
-    if custom_context:
-        full_system_instruction += "\n\nADDITIONAL CONTEXT AND GUIDELINES:\n" + custom_context
+    # Additional instructions from prompts/chatbot, cached by the prompt registry
+    return build_system_instruction("chatbot", base_instruction)
+
+def build_chat_payload(user_prompt: str, context=None):
+    """Builds the generateContent payload, with the conversation so far when given."""
+    contents = [{"parts": [{"text": user_prompt}]}]
 
-    payload = {
-        "contents": [{"parts": [{"text": user_prompt}]}],
-        "systemInstruction": {"parts": [{"text": full_system_instruction}]}
+    if context is not None:
+        contents = context.contents(user_prompt)
+        # Kept out of the system instruction so that stays the same for every
+        # session and can be served from the context cache
+        if context.summary:
+            summary = "CONVERSATION SO FAR (summary of earlier messages):\n" + context.summary
+            contents.insert(0, {"role": "user", "parts": [{"text": summary}]})
+
+    return {
+        "contents": contents,
+        "systemInstruction": {"parts": [{"text": chat_system_instruction()}]}
     }
 
-    async with httpx.AsyncClient() as client:
-        for attempt in range(6): 
-            try:
-                response = await client.post(
-                    f"{GEMINI_API_URL}?key={API_KEY}",
-                    json=payload,
-                    timeout=20.0
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "I'm sorry, I couldn't formulate a response.")
-                
-                # Retry on rate limit or server errors
-                if response.status_code in [429, 500, 503]:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                
-                print(f"API Error: {response.status_code} - {response.text}")
-                break
-            except Exception as e:
-                print(f"Connection Error: {str(e)}")
-                await asyncio.sleep(2 ** attempt)
-    
-    return "The assistant is temporarily unavailable. Please try again later."
+async def request_chat_reply(user_prompt: str, context=None, module="chatbot"):
+    """Calls Gemini API with initial instructions and retry logic. Returns None on failure."""
+    if not API_KEY:
+        return None
+
+    payload = build_chat_payload(user_prompt, context)
+    model = route_model(module, len(user_prompt))
+
+    response = await context_cache.generate_content(module, model, f"{model_url(model)}?key={API_KEY}", payload)
+    if response is not None:
+        try:
+            result = response.json()
+            return result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", EMPTY_REPLY)
+        except (ValueError, IndexError, AttributeError) as e:
+            print(f"API Error: unreadable response: {e}")
+    return None
+
+def fallback_reply():
+    """What the user sees when no reply could be generated."""
+    if not API_KEY:
+        return NO_API_KEY_REPLY
+    ai_fallback_total.inc(module="chatbot")
+    return UNAVAILABLE_REPLY
+
+async def call_gemini_api(user_prompt: str, context=None):
+    """Calls Gemini API, falling back to a canned reply when the call fails."""
+    reply = await request_chat_reply(user_prompt, context)
+    return reply if reply is not None else fallback_reply()
+
+# --- Greetings ---
+GREETING_PROMPT = "This is the start of a new conversation. Please greet the user warmly and introduce yourself as Buddy, their ADHD support companion. Keep it brief, friendly, and encouraging. Make the user feel comfortable and supported."
+
+greetings = GreetingPrefetcher(lambda: request_chat_reply(GREETING_PROMPT, module="chatbot_greeting"))
+
+metrics.Gauge("clarity_chat_greetings_pooled", "Pre-generated chat greetings ready to serve.", greetings.pooled)
+
+def _parse_sse_chunk(line: str):
+    """
+    (text, usageMetadata or None) of one `data:` line from
+    streamGenerateContent?alt=sse. The last chunk carries the usage.
+    """
+    if not line.startswith("data:"):
+        return "", None
+    try:
+        result = json.loads(line[len("data:"):].strip())
+    except ValueError:
+        return "", None
+    parts = result.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts), result.get("usageMetadata")
+
+async def stream_gemini_api(user_prompt: str, context=None):
+    """
+    Streams the reply text chunk by chunk via streamGenerateContent.
+    Retries only until the stream is open; after that a broken stream
+    just ends with what was received.
+    """
+    if not API_KEY:
+        yield NO_API_KEY_REPLY
+        return
+
+    inline_payload = build_chat_payload(user_prompt, context)
+    # Routed like request_chat_reply, so both share the chatbot context cache
+    model = route_model("chatbot", len(user_prompt))
+    stream_url = f"{model_url(model, 'streamGenerateContent')}?alt=sse&key={API_KEY}"
+    payload, cached_name = context_cache.apply_cached_context("chatbot", model, inline_payload)
+
+    while True:
+        rejected = []
+        received = False
+        try:
+            async with gemini.upstream_call(
+                "chatbot_stream", stream_url, payload, on_rejected=rejected.append, stream=True
+            ) as response:
+                if response is not None:
+                    usage = None
+                    async for line in response.aiter_lines():
+                        text, chunk_usage = _parse_sse_chunk(line)
+                        usage = chunk_usage or usage
+                        if text:
+                            received = True
+                            yield text
+                    record_usage("chatbot_stream", model, usage)
+                    if not received:
+                        yield EMPTY_REPLY
+                    return
+        except httpx.HTTPError as e:
+            # The stream broke after it was opened
+            print(f"Connection Error: {str(e)}")
+            if received:
+                return
+            break
+
+        if rejected and cached_name is not None:
+            # Rejected because of the cached context: try again inline
+            context_cache.context_cache.invalidate("chatbot", model, cached_name)
+            payload, cached_name = inline_payload, None
+            continue
+        break
+
+    ai_fallback_total.inc(module="chatbot_stream")
+    yield UNAVAILABLE_REPLY
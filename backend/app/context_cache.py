@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+import hashlib
+from app import gemini, tracing
+from app.gemini import GEMINI_API_BASE
+from app.metrics import context_cache_total
+
+# -----------------------------
+# Gemini context caching
+# -----------------------------
+# The composed system instruction (base + common.txt + module prompts +
+# user profile) is the same for every request of a module, so instead of
+# re-sending it each time it is uploaded once as a cachedContents resource
+# per (module, model) and requests refer to it by name. The cache is
+# created in the background (requests go inline until it exists),
+# its TTL is extended shortly before it runs out, and a new one replaces
+# it when the prompts change. Instructions too small for Gemini to cache,
+# a failed create or a request rejected because of the cache all fall
+# back to sending the instruction inline. Creates, refreshes and deletes
+# go through gemini.generate_content() at background priority, so they
+# wait behind user requests and respect the circuit breaker.
+
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "1") == "1"
+CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_REFRESH_MARGIN = int(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN", "300"))
+# Gemini refuses to cache less than this (estimated at ~4 characters per token)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "600"))
+
+API_KEY = os.getenv("GEMINI_API_KEY", "")
+
+
+class _CachedContext:
+    def __init__(self, digest, name, expires_at):
+        self.digest = digest
+        self.name = name              # "cachedContents/..."
+        self.expires_at = expires_at  # time.monotonic()
+
+
+class ContextCache:
+    def __init__(self, enabled=GEMINI_CONTEXT_CACHE, ttl=CONTEXT_CACHE_TTL,
+                 refresh_margin=CONTEXT_CACHE_REFRESH_MARGIN, min_tokens=CONTEXT_CACHE_MIN_TOKENS,
+                 retry_seconds=CONTEXT_CACHE_RETRY_SECONDS):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_tokens = min_tokens
+        self.retry_seconds = retry_seconds
+
+        self._entries = {}   # (module, model) -> _CachedContext
+        self._failed = {}    # (module, model, digest) -> when creating or using it last failed
+        self._tasks = {}     # (module, model) -> running create/refresh task
+
+    def lookup(self, module: str, model: str, system_instruction: str):
+        """
+        Name of the cached context holding this instruction, or None to send
+        it inline. Starts creating or refreshing the cache when needed.
+        """
+        if not self.enabled or not API_KEY or len(system_instruction) // 4 < self.min_tokens:
+            return None
+
+        key = (module, model)
+        digest = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()[:16]
+        now = time.monotonic()
+
+        entry = self._entries.get(key)
+        if entry is not None and entry.digest == digest and now < entry.expires_at:
+            if now >= entry.expires_at - self.refresh_margin:
+                self._start(key, self._refresh(key, entry))
+            context_cache_total.inc(module=module, outcome="hit")
+            return entry.name
+
+        if now - self._failed.get((module, model, digest), -self.retry_seconds) >= self.retry_seconds:
+            self._start(key, self._create(key, digest, system_instruction))
+        context_cache_total.inc(module=module, outcome="inline")
+        return None
+
+    def invalidate(self, module: str, model: str, name: str):
+        """Stops using a cached context that Gemini rejected."""
+        key = (module, model)
+        entry = self._entries.get(key)
+        if entry is not None and entry.name == name:
+            del self._entries[key]
+            self._failed[(module, model, entry.digest)] = time.monotonic()
+        context_cache_total.inc(module=module, outcome="rejected")
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start(self, key, coro):
+        """Runs one background create/refresh per key; extra requests are dropped."""
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            coro.close()
+            return
+        task = tracing.create_background_task(coro)
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key, None) if self._tasks.get(key) is t else None)
+
+    async def _create(self, key, digest, system_instruction):
+        module, model = key
+        body = {
+            "model": f"models/{model}",
+            "displayName": f"clarity-{module}-{digest}",
+            "systemInstruction": {"parts": [{"text": system_instruction}]},
+            "ttl": f"{self.ttl}s",
+        }
+        started = time.monotonic()
+        response = await gemini.generate_content("context_cache", f"{GEMINI_API_BASE}/cachedContents?key={API_KEY}", body)
+        name = None
+        if response is not None:
+            try:
+                name = response.json()["name"]
+            except (ValueError, KeyError) as e:
+                print(f"Context cache create failed ({module}): {e}")
+
+        if name is None:
+            self._failed[(module, model, digest)] = time.monotonic()
+            context_cache_total.inc(module=module, outcome="failed")
+            return
+
+        old = self._entries.get(key)
+        self._entries[key] = _CachedContext(digest, name, started + self.ttl)
+        context_cache_total.inc(module=module, outcome="created")
+
+        # The prompts changed: the previous context is no longer used
+        if old is not None and old.name != name:
+            await self._delete(old.name)
+
+    async def _refresh(self, key, entry):
+        started = time.monotonic()
+        response = await gemini.generate_content(
+            "context_cache",
+            f"{GEMINI_API_BASE}/{entry.name}?updateMask=ttl&key={API_KEY}",
+            {"ttl": f"{self.ttl}s"},
+            method="PATCH"
+        )
+
+        if response is not None:
+            entry.expires_at = started + self.ttl
+            context_cache_total.inc(module=key[0], outcome="refreshed")
+        elif self._entries.get(key) is entry:
+            # Recreated on the next lookup
+            del self._entries[key]
+
+    async def _delete(self, name):
+        # Gemini drops it at its TTL anyway, so one attempt is enough
+        response = await gemini.generate_content(
+            "context_cache", f"{GEMINI_API_BASE}/{name}?key={API_KEY}", None, max_attempts=1, method="DELETE"
+        )
+        if response is None:
+            print(f"Context cache delete failed ({name})")
+
+
+context_cache = ContextCache()
+
+
+def apply_cached_context(module: str, model: str, payload: dict):
+    """
+    (payload to send, cached context name or None): the payload's
+    systemInstruction is replaced by a cachedContent reference when a
+    cached context for it exists.
+    """
+    instruction = payload.get("systemInstruction", {}).get("parts", [{}])[0].get("text", "")
+    name = context_cache.lookup(module, model, instruction) if instruction else None
+    if name is None:
+        return payload, None
+    cached = {key: value for key, value in payload.items() if key != "systemInstruction"}
+    cached["cachedContent"] = name
+    return cached, name
+
+
+async def generate_content(module: str, model: str, url: str, payload: dict, **kwargs):
+    """
+    gemini.generate_content using the context cache when possible. A request
+    Gemini rejects because of the cache is repeated once with the
+    instruction inline.
+    """
+    cached_payload, name = apply_cached_context(module, model, payload)
+    if name is None:
+        return await gemini.generate_content(module, url, payload, **kwargs)
+
+    rejected = []
+    response = await gemini.generate_content(module, url, cached_payload, on_rejected=rejected.append, **kwargs)
+    if response is None and rejected:
+        context_cache.invalidate(module, model, name)
+        response = await gemini.generate_content(module, url, payload, **kwargs)
+    return response
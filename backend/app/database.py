@@ -1,3 +1,5 @@
+import os
+import time
 from sqlalchemy import (
     create_engine,
     Column,
@@ -7,35 +9,185 @@ from sqlalchemy import (
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
+    LargeBinary,
     event
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime
+from app.migrations import run_migrations
+from app import metrics, tracing
 
 # -----------------------------
 # Database configuration
 # -----------------------------
 
 DATABASE_URL = "sqlite:///./app.db"
-
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./app.db"
+
+# SQLite tuning, every value can be overridden from the environment.
+# WAL lets readers (e.g. /api/tasker/details) run while a writer commits.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").upper()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-64000"))   # negative = KiB
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY").upper()
+
+# Connection pool settings (shared by the sync and async engines). A local
+# SQLite file cannot drop a connection, so there is no pre-ping or recycling.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Async queue pool that records how long callers wait for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.db_pool_wait_seconds.observe(time.perf_counter() - started)
+
+# Sync engine: schema creation at startup and scripts
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT
+)
+
+# Async engine: used by all request handlers so queries never block the event loop
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=InstrumentedAsyncQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT
 )
 
-# Enable foreign key support for SQLite (SAFE, NO EXTRA WORK)
+# Foreign keys + performance pragmas, applied to every new connection
 @event.listens_for(engine, "connect")
-def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+@event.listens_for(async_engine.sync_engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
     cursor.close()
 
+# -----------------------------
+# Pool instrumentation
+# -----------------------------
+# Tracks how long request handlers keep pooled connections checked out.
+# A hold longer than DB_SLOW_CHECKOUT_SECONDS is logged, which makes any
+# connection kept open across an upstream (Gemini) await easy to spot.
+
+DB_SLOW_CHECKOUT_SECONDS = float(os.getenv("DB_SLOW_CHECKOUT_SECONDS", "1.0"))
+
+
+class PoolStats:
+    def __init__(self):
+        self.checked_out = 0
+
+
+pool_stats = PoolStats()
+
+
+@event.listens_for(async_engine.sync_engine, "checkout")
+def record_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info["checked_out_at"] = time.perf_counter()
+    pool_stats.checked_out += 1
+
+
+@event.listens_for(async_engine.sync_engine, "checkin")
+def record_pool_checkin(dbapi_connection, connection_record):
+    started = connection_record.info.pop("checked_out_at", None)
+    if started is None:
+        return
+    held = time.perf_counter() - started
+    pool_stats.checked_out -= 1
+    metrics.db_pool_held_seconds.observe(held)
+    if held > DB_SLOW_CHECKOUT_SECONDS:
+        print(f"DB connection held for {held:.2f}s (threshold {DB_SLOW_CHECKOUT_SECONDS}s)")
+
+metrics.Gauge(
+    "clarity_db_pool_checked_out", "Connections currently checked out of the async pool.",
+    lambda: pool_stats.checked_out
+)
+
+# -----------------------------
+# Query and commit timings
+# -----------------------------
+
+# Each statement and commit is also a span of the current request trace
+# (tracing.py). A statement that raises ends its span with the error and
+# is counted in clarity_db_query_errors_total.
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    operation = statement.lstrip().split(" ", 1)[0].upper()
+    span = tracing.start_span("db.query", operation=operation, statement=" ".join(statement.split())[:120])
+    if executemany:
+        span.set(rows=len(parameters))
+    conn.info.setdefault("query_started_at", []).append((time.perf_counter(), span))
+
+
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    started, span = conn.info["query_started_at"].pop()
+    span.end()
+    operation = statement.lstrip().split(" ", 1)[0].upper()
+    metrics.db_query_seconds.observe(time.perf_counter() - started, operation=operation)
+
+
+@event.listens_for(async_engine.sync_engine, "handle_error")
+def record_query_error(context):
+    # after_cursor_execute does not run for a failed statement
+    pending = context.connection.info.get("query_started_at") if context.connection is not None else None
+    if not pending or context.statement is None:
+        return
+    started, span = pending.pop()
+    span.end(context.original_exception)
+    operation = context.statement.lstrip().split(" ", 1)[0].upper()
+    metrics.db_query_seconds.observe(time.perf_counter() - started, operation=operation)
+    metrics.db_query_errors_total.inc(operation=operation)
+
+
+@event.listens_for(Session, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_started_at"] = (time.perf_counter(), tracing.start_span("db.commit"))
+
+
+@event.listens_for(Session, "after_commit")
+def record_commit_time(session):
+    started, span = session.info.pop("commit_started_at", (None, None))
+    if started is not None:
+        span.end()
+        metrics.db_commit_seconds.observe(time.perf_counter() - started)
+
 SessionLocal = sessionmaker(
     autocommit=False,
     autoflush=False,
     bind=engine
 )
 
+AsyncSessionLocal = async_sessionmaker(
+    autoflush=False,
+    expire_on_commit=False,
+    bind=async_engine
+)
+
 Base = declarative_base()
 
 # -----------------------------
@@ -46,7 +198,7 @@ class Task(Base):
     __tablename__ = "tasks"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    session_id = Column(String, nullable=False)
+    session_id = Column(String, nullable=False, index=True)
 
     input_method = Column(String, nullable=False)      # paragraph | audio | photo
     input_data = Column(Text, nullable=False)
@@ -54,6 +206,8 @@ class Task(Base):
     task_title = Column(String)
     status = Column(String, nullable=False, default="active")  # active | completed
 
+    minhash = Column(LargeBinary, nullable=True)   # similarity.py signature of input_data
+
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
 
@@ -66,6 +220,10 @@ class Task(Base):
 
 class TaskStep(Base):
     __tablename__ = "task_steps"
+    __table_args__ = (
+        # Ordered step listing in get_task_details; also serves task_id lookups
+        Index("ix_task_steps_task_id_step_index", "task_id", "step_index"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     task_id = Column(Integer, ForeignKey("tasks.id"), nullable=False)
@@ -89,13 +247,15 @@ class ReaderSession(Base):
     __tablename__ = "reader_sessions"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    session_id = Column(String, nullable=False)
+    session_id = Column(String, nullable=False, index=True)
 
     input_method = Column(String, nullable=False)
     input_text = Column(Text, nullable=False)
 
     output_text = Column(Text, nullable=False)
 
+    minhash = Column(LargeBinary, nullable=True)   # similarity.py signature of input_text
+
     created_at = Column(DateTime, default=datetime.utcnow)
 
 # -----------------------------
@@ -112,6 +272,11 @@ class ChatSession(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     ended_at = Column(DateTime, nullable=True)
 
+    # Rolling summary of older turns (chat_context.py); covers every
+    # message up to and including summary_message_id
+    summary = Column(Text, nullable=True)
+    summary_message_id = Column(Integer, nullable=True)
+
     messages = relationship(
         "ChatMessage",
         back_populates="session",
@@ -121,32 +286,91 @@ class ChatSession(Base):
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # Chat history in order; also serves session_id lookups
+        Index("ix_chat_messages_session_id_created_at", "session_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String, ForeignKey("chat_sessions.id"), nullable=False)
 
     sender = Column(String, nullable=False)   # user | ai
     message_text = Column(Text, nullable=False)
+    # Canned reply stored when Gemini failed: shown in the history, never sent as context
+    fallback = Column(Boolean, nullable=False, default=False)
 
     created_at = Column(DateTime, default=datetime.utcnow)
 
     session = relationship("ChatSession", back_populates="messages")
 
+# -----------------------------
+# AI Response Cache
+# -----------------------------
+
+class AIResponseCache(Base):
+    __tablename__ = "ai_response_cache"
+
+    key = Column(String, primary_key=True)   # sha256 of module + model + prompt + input
+    module = Column(String, nullable=False)   # tasker | paragraph
+
+    response = Column(Text, nullable=False)   # JSON encoded AI output
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+# -----------------------------
+# Similarity Index
+# -----------------------------
+
+class SimilarityBucket(Base):
+    """LSH band buckets of Task / ReaderSession MinHash signatures (similarity.py)."""
+    __tablename__ = "similarity_buckets"
+    __table_args__ = (
+        Index("ix_similarity_buckets_kind_bucket", "kind", "bucket"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)     # tasker | reader
+    bucket = Column(Integer, nullable=False)  # hash of one band of the signature
+    row_id = Column(Integer, nullable=False)  # tasks.id / reader_sessions.id
+
+# -----------------------------
+# Background Jobs
+# -----------------------------
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)   # UUID
+    kind = Column(String, nullable=False)   # tasker | reader
+
+    payload = Column(Text, nullable=False)  # JSON request body
+    status = Column(String, nullable=False, default="queued", index=True)  # queued | running | done | failed
+    result = Column(Text, nullable=True)    # JSON response body once done
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    progress = Column(String, nullable=True)  # JSON {"done": n, "total": m}, for multi-step jobs
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # Lease of a running job: renewed while it runs, see jobs.JOB_LEASE_SECONDS
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 # -----------------------------
 # FastAPI dependency
 # -----------------------------
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # -----------------------------
 # Init DB
 # -----------------------------
 
 def init_db():
+    # create_all only adds missing tables, migrations alter existing ones
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
 
@@ -0,0 +1,606 @@
+import os
+import re
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextvars
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import httpx
+from app import metrics, routing, tracing
+
+# -----------------------------
+# Shared Gemini HTTP client
+# -----------------------------
+# One pooled AsyncClient for the whole process, opened and closed by the
+# FastAPI lifespan hook in main.py. Keep-alive connections to
+# generativelanguage.googleapis.com are reused across chatbot, paragraph
+# and tasker instead of paying DNS + TCP + TLS on every call.
+
+# Base URL of the Gemini REST API. Point it at tools/mock_gemini.py to run
+# the backend (and tools/benchmark.py) without touching the real API.
+GEMINI_API_BASE = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+
+GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "1") == "1"
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "100"))
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "20"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "30"))
+
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "5"))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT", "20"))
+GEMINI_WRITE_TIMEOUT = float(os.getenv("GEMINI_WRITE_TIMEOUT", "10"))
+GEMINI_POOL_TIMEOUT = float(os.getenv("GEMINI_POOL_TIMEOUT", "5"))
+
+_client = None
+
+
+def model_url(model: str, method: str = "generateContent"):
+    """Full endpoint URL for a model method, e.g. generateContent."""
+    return f"{GEMINI_API_BASE}/models/{model}:{method}"
+
+
+_MODEL_IN_URL = re.compile(r"/models/([^/:?]+):")
+
+
+def url_model(url: str):
+    """The model a model_url() points at, None for other endpoints."""
+    match = _MODEL_IN_URL.search(url)
+    return match.group(1) if match else None
+
+
+def _http2_available():
+    """HTTP/2 needs the optional `h2` package (httpx[http2])."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_client():
+    """Builds the pooled client from the environment settings above."""
+    http2 = GEMINI_HTTP2 and _http2_available()
+    if GEMINI_HTTP2 and not http2:
+        print("GEMINI_HTTP2 is on but 'h2' is not installed, falling back to HTTP/1.1")
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=GEMINI_MAX_CONNECTIONS,
+            max_keepalive_connections=GEMINI_MAX_KEEPALIVE,
+            keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=GEMINI_CONNECT_TIMEOUT,
+            read=GEMINI_READ_TIMEOUT,
+            write=GEMINI_WRITE_TIMEOUT,
+            pool=GEMINI_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def start_client():
+    """Opens the shared client. Called once from the app lifespan."""
+    global _client
+    if _client is None:
+        _client = create_client()
+    return _client
+
+
+async def close_client():
+    """Closes the shared client and its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client():
+    """
+    Returns the shared client. Created lazily if the lifespan hook has not
+    run (e.g. modules imported from a script), so callers never have to check.
+    """
+    global _client
+    if _client is None:
+        _client = create_client()
+    return _client
+
+
+# -----------------------------
+# Upstream call policy
+# -----------------------------
+# Every Gemini call goes through upstream_call() (generate_content() for
+# whole responses, the chat stream directly), which applies:
+#   - jittered exponential backoff that honours Retry-After
+#   - a total deadline per request (attempts + sleeps)
+#   - a global cap on concurrent upstream calls, handed out by priority:
+#     interactive chat first, then bulk tasker/reader, then background
+#     work (jobs, summaries); GEMINI_INTERACTIVE_RESERVED slots are only
+#     ever used by interactive calls
+#   - a circuit breaker that fails fast (callers use their fallback
+#     responses) while the upstream is unhealthy
+
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+GEMINI_DEADLINE_SECONDS = float(os.getenv("GEMINI_DEADLINE_SECONDS", "30"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "8"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+GEMINI_INTERACTIVE_RESERVED = int(os.getenv("GEMINI_INTERACTIVE_RESERVED", "4"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Failures where the request most likely never reached the model.
+# Read timeouts are not retried: the call already used its full budget.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
+
+class CircuitBreaker:
+    """
+    closed    -> calls pass; `threshold` consecutive failures open it
+    open      -> calls fail fast until `cooldown` seconds have passed
+    half_open -> a single probe call decides between closed and open
+    """
+
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def cancel_probe(self):
+        """The call allowed through never reached the upstream."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                print(f"Gemini circuit breaker opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk", PRIORITY_BACKGROUND: "background"}
+
+# Default priority per module; anything not listed is bulk
+MODULE_PRIORITIES = {
+    "chatbot": PRIORITY_INTERACTIVE,
+    "chatbot_stream": PRIORITY_INTERACTIVE,
+    "chatbot_greeting": PRIORITY_INTERACTIVE,
+    "chatbot_summary": PRIORITY_BACKGROUND,
+    "context_cache": PRIORITY_BACKGROUND,
+}
+
+# Set by code running on behalf of nobody waiting (e.g. the job worker)
+# to lower the priority of every Gemini call it makes
+upstream_priority = contextvars.ContextVar("upstream_priority", default=None)
+
+
+def call_priority(module: str):
+    override = upstream_priority.get()
+    if override is not None:
+        return override
+    return MODULE_PRIORITIES.get(module, PRIORITY_BULK)
+
+
+class PrioritySlots:
+    """
+    Semaphore that hands free slots to the most urgent waiter first (FIFO
+    within a priority). `reserved` slots are kept for interactive calls.
+    """
+
+    def __init__(self, capacity, reserved=0):
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self.in_use = 0
+        self._waiters = []   # heap of [priority, seq, future]
+        self._seq = itertools.count()
+
+    def _limit(self, priority):
+        return self.capacity if priority == PRIORITY_INTERACTIVE else self.capacity - self.reserved
+
+    def _queued_ahead(self, priority):
+        return any(p <= priority and not f.done() for p, _, f in self._waiters)
+
+    def try_acquire(self, priority=PRIORITY_BULK):
+        """Takes a slot only if one is free right now and nobody more urgent is waiting."""
+        if self.in_use < self._limit(priority) and not self._queued_ahead(priority):
+            self.in_use += 1
+            return True
+        return False
+
+    async def acquire(self, priority=PRIORITY_BULK):
+        if self.try_acquire(priority):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._seq), future])
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the waiter gave up
+                self.release()
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)   # cancelled or timed out
+                continue
+            # The head is the most urgent waiter, if it cannot go nobody can
+            if self.in_use >= self._limit(priority):
+                return
+            heapq.heappop(self._waiters)
+            self.in_use += 1
+            future.set_result(None)
+
+    def waiting(self):
+        counts = {}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                key = (PRIORITY_NAMES[priority],)
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+
+breaker = CircuitBreaker()
+_upstream_slots = PrioritySlots(GEMINI_MAX_CONCURRENCY, GEMINI_INTERACTIVE_RESERVED)
+
+metrics.Gauge(
+    "clarity_gemini_breaker_open", "1 while the Gemini circuit breaker is open or probing.",
+    lambda: 0 if breaker.state == "closed" else 1
+)
+metrics.Gauge(
+    "clarity_gemini_slots_in_use", "Upstream Gemini call slots in use.",
+    lambda: _upstream_slots.in_use
+)
+metrics.Gauge(
+    "clarity_gemini_slots_waiting", "Gemini calls queued for an upstream slot, by priority.",
+    _upstream_slots.waiting, labels=("priority",)
+)
+
+
+def retry_after_seconds(response):
+    """Parses a Retry-After header (delta seconds or HTTP date), or None."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, response=None):
+    """Full-jitter exponential backoff, never shorter than Retry-After."""
+    delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+    retry_after = retry_after_seconds(response)
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, GEMINI_BACKOFF_BASE))
+    return delay
+
+
+def attempt_timeout(remaining: float):
+    """Client timeouts, capped so one attempt cannot outlive the request deadline."""
+    return httpx.Timeout(
+        connect=min(GEMINI_CONNECT_TIMEOUT, remaining),
+        read=min(GEMINI_READ_TIMEOUT, remaining),
+        write=min(GEMINI_WRITE_TIMEOUT, remaining),
+        pool=min(GEMINI_POOL_TIMEOUT, remaining),
+    )
+
+
+@asynccontextmanager
+async def upstream_slot(timeout: float, priority=PRIORITY_BULK):
+    """Holds one of the GEMINI_MAX_CONCURRENCY upstream slots, queueing by priority."""
+    with tracing.span("gemini.slot_wait", priority=PRIORITY_NAMES[priority]):
+        await asyncio.wait_for(_upstream_slots.acquire(priority), timeout)
+    try:
+        yield
+    finally:
+        _upstream_slots.release()
+
+
+async def post(module: str, url: str, payload: dict, timeout=None, method="POST"):
+    """Sends a request on the shared client, recording the call latency per module."""
+    started = time.perf_counter()
+    status = "error"
+    call = tracing.start_span("gemini.http", module=module, model=url_model(url) or "-")
+    try:
+        response = await get_client().request(method, url, json=payload, timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+        status = response.status_code
+        return response
+    except BaseException as e:
+        call.end(e)
+        raise
+    finally:
+        call.set(status=status).end()
+        elapsed = time.perf_counter() - started
+        metrics.gemini_request_seconds.observe(elapsed, module=module, status=status)
+        if status == 200:
+            latencies.record(module, elapsed)
+            model = url_model(url)
+            if model is not None:
+                metrics.gemini_model_seconds.observe(elapsed, model=model, module=module)
+                record_response_usage(module, model, response)
+
+
+def record_response_usage(module: str, model: str, response):
+    try:
+        usage = response.json().get("usageMetadata")
+    except (ValueError, AttributeError):
+        return
+    routing.record_usage(module, model, usage)
+
+
+# -----------------------------
+# Hedged requests
+# -----------------------------
+# For modules listed in GEMINI_HEDGE_MODULES (e.g. "chatbot,tasker"), an
+# attempt that has not answered within the module's recent
+# GEMINI_HEDGE_PERCENTILE latency gets a second identical request; the
+# first successful answer wins and the other is cancelled. Hedges are
+# paid for from a budget that grows by GEMINI_HEDGE_BUDGET per request,
+# so they add at most that fraction of extra upstream load.
+
+GEMINI_HEDGE_MODULES = {m.strip() for m in os.getenv("GEMINI_HEDGE_MODULES", "").split(",") if m.strip()}
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "0.5"))
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY", "3"))
+GEMINI_HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0.05"))
+GEMINI_HEDGE_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies per module."""
+
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = {}
+
+    def record(self, module, seconds):
+        self._samples.setdefault(module, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, module, pct):
+        samples = self._samples.get(module)
+        if not samples or len(samples) < GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class HedgeBudget:
+    """Token bucket: every hedgeable request earns `ratio` tokens, a hedge costs one."""
+
+    def __init__(self, ratio=GEMINI_HEDGE_BUDGET, burst=10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+latencies = LatencyTracker()
+hedge_budget = HedgeBudget()
+
+
+def hedge_delay(module: str):
+    observed = latencies.percentile(module, GEMINI_HEDGE_PERCENTILE)
+    if observed is None:
+        return GEMINI_HEDGE_DEFAULT_DELAY
+    return max(GEMINI_HEDGE_MIN_DELAY, observed)
+
+
+async def hedged_post(module: str, url: str, payload: dict, timeout=None, priority=PRIORITY_BULK):
+    """post() with a backup request after hedge_delay(); first 200 wins."""
+    hedge_budget.earn()
+    primary = asyncio.create_task(post(module, url, payload, timeout))
+    hedge = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay(module))
+        # The hedge needs a free upstream slot of its own; never queue for one
+        if done or not _upstream_slots.try_acquire(priority):
+            return await primary
+        if not hedge_budget.try_spend():
+            _upstream_slots.release()
+            return await primary
+
+        try:
+            hedge = asyncio.create_task(post(module, url, payload, timeout))
+            metrics.gemini_hedges_total.inc(module=module, outcome="sent")
+
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code == 200:
+                        if task is hedge:
+                            metrics.gemini_hedges_total.inc(module=module, outcome="won")
+                        return task.result()
+            # Neither succeeded: report the primary's outcome to the retry loop
+            return primary.result()
+        finally:
+            _upstream_slots.release()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def generate_content(module: str, url: str, payload: dict, max_attempts=GEMINI_MAX_ATTEMPTS,
+                           deadline_seconds=GEMINI_DEADLINE_SECONDS, on_rejected=None, method="POST"):
+    """
+    Calls Gemini under the shared policy. Returns the 200 response, or None
+    when the call failed, ran out of attempts or time, or the breaker is open.
+    `on_rejected(response)` is called when the request itself was refused (4xx).
+    Other endpoints (e.g. cachedContents) pass their HTTP `method`.
+    """
+    with tracing.span("gemini.generate_content", module=module, model=url_model(url) or "-") as call:
+        async with upstream_call(module, url, payload, max_attempts, deadline_seconds, on_rejected, method) as response:
+            call.set(outcome="ok" if response is not None else "failed")
+            return response
+
+
+@asynccontextmanager
+async def post_stream(module: str, url: str, payload: dict, timeout=None):
+    """
+    Opens a streamed POST on the shared client; the caller reads the body
+    inside the block. Latency is recorded up to the response headers, i.e.
+    until tokens start flowing.
+    """
+    started = time.perf_counter()
+    status = "error"
+    # Not made current: the caller yields to its own consumer while it is open
+    call = tracing.start_span("gemini.stream", module=module, model=url_model(url) or "-")
+    try:
+        async with get_client().stream(
+            "POST", url, json=payload, timeout=timeout or httpx.USE_CLIENT_DEFAULT
+        ) as response:
+            status = response.status_code
+            first_byte = time.perf_counter() - started
+            call.set(status=status, first_byte_ms=round(first_byte * 1000, 1))
+            metrics.gemini_request_seconds.observe(first_byte, module=module, status=status)
+            yield response
+            model = url_model(url)
+            if status == 200 and model is not None:
+                metrics.gemini_model_seconds.observe(time.perf_counter() - started, model=model, module=module)
+    except BaseException as e:
+        if status == "error":
+            metrics.gemini_request_seconds.observe(time.perf_counter() - started, module=module, status=status)
+        call.end(e)
+        raise
+    finally:
+        call.end()
+
+
+@asynccontextmanager
+async def upstream_call(module: str, url: str, payload: dict, max_attempts=GEMINI_MAX_ATTEMPTS,
+                        deadline_seconds=GEMINI_DEADLINE_SECONDS, on_rejected=None, method="POST", stream=False):
+    """
+    The shared policy around one Gemini call: breaker, priority slot,
+    deadline, backoff and retries. Yields the 200 response, or None like
+    generate_content(). With `stream=True` the response body has not been
+    read yet; the caller iterates it inside the block, which keeps the
+    upstream slot. Retries end once a response is yielded.
+    """
+    async with AsyncExitStack() as held:
+        yield await _open_call(held, module, url, payload, max_attempts, deadline_seconds, on_rejected, method, stream)
+
+
+async def _open_call(held, module, url, payload, max_attempts, deadline_seconds, on_rejected, method, stream):
+    deadline = time.monotonic() + deadline_seconds
+    priority = call_priority(module)
+
+    for attempt in range(max_attempts):
+        if not breaker.allow():
+            metrics.gemini_breaker_rejections_total.inc(module=module)
+            return None
+        probing = breaker.state == "half_open"
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if probing:
+                breaker.cancel_probe()
+            return None
+
+        response = None
+        # The slot (and an open stream) of this attempt, handed to `held` on success
+        attempt_held = AsyncExitStack()
+        try:
+            await attempt_held.enter_async_context(upstream_slot(remaining, priority))
+            timeout = attempt_timeout(deadline - time.monotonic())
+            if stream:
+                response = await attempt_held.enter_async_context(post_stream(module, url, payload, timeout))
+            elif module in GEMINI_HEDGE_MODULES and method == "POST":
+                response = await hedged_post(module, url, payload, timeout, priority)
+            else:
+                response = await post(module, url, payload, timeout=timeout, method=method)
+        except asyncio.TimeoutError:
+            # Deadline passed while waiting for a free upstream slot
+            if probing:
+                breaker.cancel_probe()
+            await attempt_held.aclose()
+            return None
+        except asyncio.CancelledError:
+            if probing:
+                breaker.cancel_probe()
+            await attempt_held.aclose()
+            raise
+        except RETRYABLE_ERRORS as e:
+            print(f"Gemini connection error ({module}): {e}")
+            breaker.record_failure()
+            status = "error"
+        except httpx.HTTPError as e:
+            print(f"Gemini request failed ({module}): {e}")
+            breaker.record_failure()
+            await attempt_held.aclose()
+            return None
+        else:
+            if response.status_code == 200:
+                breaker.record_success()
+                await held.enter_async_context(attempt_held.pop_all())
+                return response
+            if response.status_code not in RETRYABLE_STATUS:
+                # The upstream is healthy, the request itself was rejected
+                breaker.record_success()
+                if stream:
+                    await response.aread()
+                print(f"API Error ({module}): {response.status_code} - {response.text}")
+                if on_rejected is not None:
+                    on_rejected(response)
+                await attempt_held.aclose()
+                return None
+            breaker.record_failure()
+            status = response.status_code
+        await attempt_held.aclose()
+
+        delay = backoff_delay(attempt, response)
+        if attempt == max_attempts - 1 or time.monotonic() + delay >= deadline:
+            return None
+        metrics.gemini_retries_total.inc(module=module, status=status)
+        with tracing.span("gemini.backoff", attempt=attempt + 1, status=status, delay=round(delay, 3)):
+            await asyncio.sleep(delay)
+
+    return None
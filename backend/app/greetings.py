@@ -0,0 +1,132 @@
+import os
+import asyncio
+from app import gemini, tracing
+from app.prompts import prompt_version
+from app.metrics import chat_greetings_total
+
+# -----------------------------
+# Speculative chat greetings
+# -----------------------------
+# The Flutter app calls /api/chat/start and right after it
+# /api/chat/greeting/{session_id}. start_chat already kicks off the greeting
+# call, so it is mostly done by the time the second request arrives.
+# Behind that sits a small pool of ready greetings for the current chatbot
+# prompt version (common.txt with the user profile + prompts/chatbot). The
+# pool answers when the speculative call is still running or failed, is
+# topped up in the background and rebuilt when the profile changes.
+
+GREETING_POOL_SIZE = int(os.getenv("GREETING_POOL_SIZE", "4"))
+GREETING_PENDING_TTL = float(os.getenv("GREETING_PENDING_TTL", "120"))
+
+
+class GreetingPrefetcher:
+    def __init__(self, generate, pool_size=GREETING_POOL_SIZE, pending_ttl=GREETING_PENDING_TTL):
+        self.generate = generate    # async () -> greeting text, or None when the call failed
+        self.pool_size = pool_size
+        self.pending_ttl = pending_ttl
+
+        self._pending = {}   # session_id -> (task, prompt version, started_at)
+        self._pool = {}      # prompt version -> [greeting, ...]
+        self._refill = None
+
+    def prefetch(self, session_id: str):
+        """Starts generating the greeting for a new session (called by start_chat)."""
+        loop = asyncio.get_running_loop()
+        self._sweep(loop.time())
+        version = prompt_version("chatbot")
+        self._pending[session_id] = (tracing.create_background_task(self.generate()), version, loop.time())
+        self.refill()
+
+    async def get(self, session_id: str):
+        """
+        The greeting for a session: the speculative result if it is ready,
+        else a pooled one, else whatever the pending (or a fresh) call returns.
+        Returns None when no greeting could be generated.
+        """
+        version = prompt_version("chatbot")
+        task, task_version, _ = self._pending.pop(session_id, (None, None, None))
+
+        if task is not None and task.done():
+            greeting = self._result(task)
+            if greeting is not None:
+                chat_greetings_total.inc(source="prefetched")
+                return greeting
+
+        pooled = self._take(version)
+        if pooled is not None:
+            if task is not None and not task.done():
+                # Not needed for this session any more, keep it for the next one
+                task.add_done_callback(lambda t: self._keep(task_version, t))
+            self.refill()
+            chat_greetings_total.inc(source="pool")
+            return pooled
+
+        if task is None or task.done():
+            greeting = await self.generate()
+        else:
+            greeting = await task
+        chat_greetings_total.inc(source="generated" if greeting is not None else "failed")
+        return greeting
+
+    def refill(self):
+        """Tops up the pool for the current prompt version in the background."""
+        if self._refill is None or self._refill.done():
+            self._refill = tracing.create_background_task(self._fill(prompt_version("chatbot")))
+
+    def refresh(self):
+        """Drops pooled greetings and rebuilds the pool, e.g. after a profile update."""
+        if self._refill is not None and not self._refill.done():
+            self._refill.cancel()
+        self._pool.clear()
+        self.refill()
+
+    async def stop(self):
+        tasks = [task for task, _, _ in self._pending.values()]
+        if self._refill is not None:
+            tasks.append(self._refill)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pending.clear()
+
+    def pooled(self):
+        return sum(len(pool) for pool in self._pool.values())
+
+    async def _fill(self, version):
+        # Runs in its own task, so this only lowers the pool's own calls
+        gemini.upstream_priority.set(gemini.PRIORITY_BACKGROUND)
+        # Greetings written for an older profile are not served any more
+        for other in [v for v in self._pool if v != version]:
+            del self._pool[other]
+        pool = self._pool.setdefault(version, [])
+        while len(pool) < self.pool_size:
+            greeting = await self.generate()
+            if greeting is None:
+                # Upstream is failing; the next take or prefetch tries again
+                return
+            pool.append(greeting)
+
+    def _take(self, version):
+        pool = self._pool.get(version)
+        return pool.pop(0) if pool else None
+
+    def _keep(self, version, task):
+        greeting = self._result(task)
+        pool = self._pool.get(version)
+        if greeting is not None and pool is not None and len(pool) < self.pool_size:
+            pool.append(greeting)
+
+    def _result(self, task):
+        if task.cancelled() or task.exception() is not None:
+            return None
+        return task.result()
+
+    def _sweep(self, now):
+        """Forgets speculative greetings that were never asked for."""
+        expired = [sid for sid, (_, _, started) in self._pending.items() if now - started > self.pending_ttl]
+        for session_id in expired:
+            task, version, _ = self._pending.pop(session_id)
+            if task.done():
+                self._keep(version, task)
+            else:
+                task.cancel()
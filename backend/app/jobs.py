@@ -0,0 +1,311 @@
+import os
+import json
+import uuid
+import random
+import asyncio
+from datetime import datetime, timedelta
+from fastapi import APIRouter, HTTPException, Query
+from sqlalchemy import delete, select, update
+from app.database import AsyncSessionLocal, Job
+from app import gemini, metrics, tracing
+
+router = APIRouter()
+
+# -----------------------------
+# Background job queue
+# -----------------------------
+# Tasker and reader requests sent with ?async=true are stored in the jobs
+# table and answered with 202 + job id straight away. A fixed pool of
+# workers runs the AI call and persistence; clients poll (or long-poll
+# with ?wait=N) GET /api/jobs/{job_id}. Queued jobs are picked up again
+# after a restart. A running job holds a lease (jobs.updated_at, renewed
+# while it runs); jobs whose lease ran out, i.e. whose process died, are
+# re-queued by any process, so jobs that other live processes are running
+# are left alone. When the backlog is full new jobs are refused with
+# 503 + Retry-After instead of piling up.
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "200"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Delay before retrying a failed job, doubled per attempt (with jitter)
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "120"))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "72"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+FINISHED = ("done", "failed")
+
+# kind -> async handler(payload dict, progress) -> JSON-serialisable result,
+# where `await progress(done, total)` reports progress to polling clients
+_handlers = {}
+
+
+def register_job_handler(kind: str, handler):
+    """Called by modules at import time, e.g. register_job_handler("tasker", ...)."""
+    _handlers[kind] = handler
+
+
+def is_permanent_failure(error: Exception):
+    """Errors that would recur on every attempt: the request itself is invalid (4xx)."""
+    if isinstance(error, HTTPException):
+        return error.status_code < 500
+    return False
+
+
+def retry_delay(attempts: int):
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def job_to_dict(job: Job):
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "progress": json.loads(job.progress) if job.progress else None,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS, queue_max=JOB_QUEUE_MAX, max_attempts=JOB_MAX_ATTEMPTS):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.max_attempts = max_attempts
+
+        self._queue = None
+        self._tasks = []
+        self._running = set()   # ids of the jobs this process is running
+        self._finished = {}   # job_id -> asyncio.Event for long-polling clients
+        self._pollers = {}    # job_id -> number of clients waiting on that event
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        await self._recover()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._reclaim_expired()))
+
+    async def stop(self):
+        """Stops the workers. Interrupted jobs are handed back to the queue."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._running:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(Job)
+                    .where(Job.id.in_(self._running), Job.status == "running")
+                    .values(status="queued")
+                )
+                await db.commit()
+            self._running.clear()
+
+    async def _recover(self):
+        cutoff = datetime.utcnow() - timedelta(hours=JOB_RETENTION_HOURS)
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(Job).where(Job.status.in_(FINISHED), Job.finished_at < cutoff))
+            await db.commit()
+        await self._requeue_expired()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Job.id).where(Job.status == "queued").order_by(Job.created_at)
+            )
+            for job_id in result.scalars():
+                self._queue.put_nowait(job_id)
+
+    async def _requeue_expired(self):
+        """Re-queues running jobs whose lease ran out; returns their ids."""
+        expired = datetime.utcnow() - timedelta(seconds=JOB_LEASE_SECONDS)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(Job)
+                .where(Job.status == "running", Job.updated_at < expired)
+                .values(status="queued", updated_at=datetime.utcnow())
+                .returning(Job.id)
+            )
+            job_ids = result.scalars().all()
+            await db.commit()
+        return job_ids
+
+    async def _reclaim_expired(self):
+        """Picks up the jobs of processes that died without a restart of this one."""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 2)
+            try:
+                for job_id in await self._requeue_expired():
+                    print(f"Job {job_id} lease expired, re-queued")
+                    self._queue.put_nowait(job_id)
+            except Exception as e:
+                print(f"Job lease sweep failed: {e}")
+
+    async def _renew_lease(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(Job)
+                        .where(Job.id == job_id, Job.status == "running")
+                        .values(updated_at=datetime.utcnow())
+                    )
+                    await db.commit()
+            except Exception as e:
+                print(f"Job {job_id} lease renewal failed: {e}")
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, kind: str, payload: dict):
+        """Stores a new job and queues it. Raises 503 when the backlog is full."""
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="Job queue is not running")
+        if self.depth() >= self.queue_max:
+            metrics.jobs_total.inc(kind=kind, status="rejected")
+            raise HTTPException(
+                status_code=503,
+                detail="Too many queued jobs, please retry shortly",
+                headers={"Retry-After": "5"}
+            )
+
+        job_id = str(uuid.uuid4())
+        async with AsyncSessionLocal() as db:
+            db.add(Job(id=job_id, kind=kind, payload=json.dumps(payload), status="queued"))
+            await db.commit()
+        self._queue.put_nowait(job_id)
+        metrics.jobs_total.inc(kind=kind, status="queued")
+        return job_id
+
+    async def wait(self, job_id: str, timeout: float):
+        """Waits up to `timeout` seconds for the job to finish."""
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        self._pollers[job_id] = self._pollers.get(job_id, 0) + 1
+        try:
+            # Re-check after registering, the job may have finished in between
+            async with AsyncSessionLocal() as db:
+                job = await db.get(Job, job_id)
+            if job is None or job.status in FINISHED:
+                return
+
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            # The last poller drops the event; a finished job already popped it
+            self._pollers[job_id] -= 1
+            if not self._pollers[job_id]:
+                del self._pollers[job_id]
+                if self._finished.get(job_id) is event:
+                    del self._finished[job_id]
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Job {job_id} crashed the worker step: {e}")
+
+    async def _set_progress(self, job_id: str, done: int, total: int):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Job).where(Job.id == job_id).values(progress=json.dumps({"done": done, "total": total}))
+            )
+            await db.commit()
+
+    async def _run(self, job_id: str):
+        # Traced like a request, under the job id (a uuid is 32 hex digits)
+        root = tracing.start_trace("job", trace_id=job_id.replace("-", ""), job_id=job_id)
+        token = tracing.activate(root)
+        try:
+            await self._execute(job_id, root)
+        finally:
+            tracing.deactivate(token)
+            tracing.finish_trace(root)
+
+    async def _execute(self, job_id: str, root):
+        async with AsyncSessionLocal() as db:
+            # Claimed in one statement, so a job queued twice (another
+            # process, a restart racing _recover) runs only once
+            claimed = await db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", attempts=Job.attempts + 1,
+                        started_at=datetime.utcnow(), updated_at=datetime.utcnow())
+            )
+            if claimed.rowcount != 1:
+                return
+            job = await db.get(Job, job_id)
+            kind, payload, attempts = job.kind, json.loads(job.payload), job.attempts
+            await db.commit()
+        root.name = f"job {kind}"
+        root.set(attempt=attempts)
+
+        handler = _handlers.get(kind)
+        status, result, error = "done", None, None
+        self._running.add(job_id)
+        lease = tracing.create_background_task(self._renew_lease(job_id))
+        # Nobody is waiting on the request: interactive calls go first
+        priority = gemini.upstream_priority.set(gemini.PRIORITY_BACKGROUND)
+        try:
+            if handler is None:
+                raise HTTPException(status_code=400, detail=f"No handler for job kind '{kind}'")
+            result = await handler(payload, lambda done, total: self._set_progress(job_id, done, total))
+        except Exception as e:
+            print(f"Job {job_id} ({kind}) failed on attempt {attempts}: {e}")
+            retry = attempts < self.max_attempts and not is_permanent_failure(e)
+            status = "queued" if retry else "failed"
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+        finally:
+            gemini.upstream_priority.reset(priority)
+            lease.cancel()
+
+        async with AsyncSessionLocal() as db:
+            job = await db.get(Job, job_id)
+            job.status = status
+            job.error = error
+            job.updated_at = datetime.utcnow()
+            if status in FINISHED:
+                job.result = json.dumps(result, ensure_ascii=False) if result is not None else None
+                job.finished_at = datetime.utcnow()
+            await db.commit()
+        self._running.discard(job_id)
+
+        if status == "queued":
+            # Stays queued in the table meanwhile, so a restart still picks it up
+            asyncio.get_running_loop().call_later(retry_delay(attempts), self._queue.put_nowait, job_id)
+            return
+
+        root.set(status=status)
+        metrics.jobs_total.inc(kind=kind, status=status)
+        event = self._finished.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+
+job_queue = JobQueue()
+
+metrics.Gauge("clarity_job_queue_depth", "Background jobs waiting for a worker.", job_queue.depth)
+
+
+@router.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str, wait: float = Query(0, ge=0)):
+    """Job status and, once done, its result. ?wait=N long-polls for up to N seconds."""
+    async with AsyncSessionLocal() as db:
+        job = await db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if wait and job.status not in FINISHED:
+        await job_queue.wait(job_id, min(wait, JOB_MAX_WAIT_SECONDS))
+        async with AsyncSessionLocal() as db:
+            job = await db.get(Job, job_id)
+
+    return job_to_dict(job)
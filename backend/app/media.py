@@ -0,0 +1,217 @@
+import io
+import os
+import base64
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import binascii
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException, UploadFile
+from app import tracing
+from app.metrics import media_prepare_seconds, media_bytes_total
+
+# -----------------------------
+# Image / audio preprocessing
+# -----------------------------
+# input_method "image"/"photo" and "audio" carry a base64 file (or come in
+# as a multipart upload). Before it goes to Gemini as an inline_data part,
+# images are downscaled and re-encoded as JPEG (Pillow) and audio is
+# trimmed and transcoded to mono Opus (ffmpeg). That work is CPU-bound, so
+# it runs in a small process pool instead of on the event loop. Without
+# Pillow or ffmpeg the file is passed through unchanged.
+
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_MAX_UPLOAD_BYTES = int(os.getenv("MEDIA_MAX_UPLOAD_MB", "20")) * 1024 * 1024
+MEDIA_IMAGE_MAX_SIDE = int(os.getenv("MEDIA_IMAGE_MAX_SIDE", "1536"))
+MEDIA_IMAGE_QUALITY = int(os.getenv("MEDIA_IMAGE_QUALITY", "80"))
+MEDIA_AUDIO_MAX_SECONDS = int(os.getenv("MEDIA_AUDIO_MAX_SECONDS", "300"))
+MEDIA_AUDIO_BITRATE = os.getenv("MEDIA_AUDIO_BITRATE", "24k")
+MEDIA_FFMPEG_TIMEOUT = float(os.getenv("MEDIA_FFMPEG_TIMEOUT", "60"))
+
+MEDIA_METHODS = {"image": "image", "photo": "image", "audio": "audio"}
+
+# Leading bytes -> MIME type, for files we cannot or do not re-encode
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"ID3", "audio/mp3"),
+    (b"\xff\xfb", "audio/mp3"),
+    (b"\xff\xf3", "audio/mp3"),
+    (b"OggS", "audio/ogg"),
+    (b"fLaC", "audio/flac"),
+    (b"\x1aE\xdf\xa3", "audio/webm"),
+    (b"\xff\xf1", "audio/aac"),
+    (b"\xff\xf9", "audio/aac"),
+]
+
+
+def sniff_mime(raw: bytes, default: str):
+    if raw[:4] == b"RIFF" and raw[8:12] == b"WEBP":
+        return "image/webp"
+    if raw[:4] == b"RIFF" and raw[8:12] == b"WAVE":
+        return "audio/wav"
+    if raw[4:8] == b"ftyp":
+        brand = raw[8:12]
+        if brand in (b"heic", b"heix", b"mif1"):
+            return "image/heic"
+        return "audio/mp4"
+    for signature, mime_type in _SIGNATURES:
+        if raw.startswith(signature):
+            return mime_type
+    return default
+
+
+class PreparedMedia:
+    def __init__(self, kind, data, mime_type):
+        self.kind = kind
+        self.data = data
+        self.mime_type = mime_type
+
+    def part(self):
+        """The generateContent part carrying the file."""
+        return {"inline_data": {"mime_type": self.mime_type, "data": base64.b64encode(self.data).decode("ascii")}}
+
+    def digest(self):
+        """Stands in for the input text in response cache keys."""
+        return f"{self.kind}:{self.mime_type}:{hashlib.sha256(self.data).hexdigest()}"
+
+
+def media_kind(input_method: str):
+    """'image' or 'audio' for file inputs, None for text."""
+    return MEDIA_METHODS.get((input_method or "").lower())
+
+
+def decode_upload(input_data: str):
+    """Decodes a base64 (or data: URL) upload. Raises 400/413 for bad input."""
+    if input_data.startswith("data:"):
+        input_data = input_data.partition(",")[2]
+    if len(input_data) * 3 // 4 > MEDIA_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Uploaded file is too large")
+    try:
+        raw = base64.b64decode(input_data, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="input_data must be base64 for image and audio input")
+    if not raw:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+    return raw
+
+
+def check_upload(input_method: str, input_data: str):
+    """Validates a file input up front (e.g. before it is queued as a job)."""
+    if media_kind(input_method) is not None:
+        decode_upload(input_data)
+
+
+async def read_upload(file: UploadFile):
+    """Reads a multipart upload as base64 input_data, refusing oversized files."""
+    raw = await file.read(MEDIA_MAX_UPLOAD_BYTES + 1)
+    if len(raw) > MEDIA_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Uploaded file is too large")
+    if not raw:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+    return base64.b64encode(raw).decode("ascii")
+
+
+def describe_upload(kind: str, raw: bytes):
+    """Stored in place of the file itself (tasks.input_data / reader_sessions.input_text)."""
+    return f"[{kind} upload, {max(1, len(raw) // 1024)} KB]"
+
+
+# --- Worker process side ---
+
+def _prepare_image(raw: bytes):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return raw, sniff_mime(raw, "image/jpeg")
+
+    with Image.open(io.BytesIO(raw)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((MEDIA_IMAGE_MAX_SIDE, MEDIA_IMAGE_MAX_SIDE))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=MEDIA_IMAGE_QUALITY, optimize=True)
+
+    data = out.getvalue()
+    original_type = sniff_mime(raw, "")
+    # A small, already compressed original is kept as it is
+    if len(data) >= len(raw) and original_type in ("image/jpeg", "image/png", "image/webp"):
+        return raw, original_type
+    return data, "image/jpeg"
+
+
+def _prepare_audio(raw: bytes):
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return raw, sniff_mime(raw, "audio/wav")
+
+    # Temp files rather than pipes: mp4/m4a input needs a seekable file
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "input")
+        target = os.path.join(tmp, "output.ogg")
+        with open(source, "wb") as f:
+            f.write(raw)
+        subprocess.run(
+            [
+                ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                "-i", source, "-t", str(MEDIA_AUDIO_MAX_SECONDS), "-vn",
+                "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", MEDIA_AUDIO_BITRATE,
+                target,
+            ],
+            check=True, capture_output=True, timeout=MEDIA_FFMPEG_TIMEOUT
+        )
+        with open(target, "rb") as f:
+            return f.read(), "audio/ogg"
+
+
+_PREPARERS = {"image": _prepare_image, "audio": _prepare_audio}
+
+
+# --- Event loop side ---
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Never fork: this process runs the event loop and the httpx and
+        # aiosqlite threads, and a forked child can inherit a held lock.
+        # forkserver forks from a clean single-threaded server (spawn
+        # where it is not available, e.g. Windows)
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _executor = ProcessPoolExecutor(MEDIA_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+def shutdown_media_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def prepare_media(kind: str, raw: bytes):
+    """Shrinks an image or audio file in the process pool. Raises 400 if it cannot be read."""
+    loop = asyncio.get_running_loop()
+    with media_prepare_seconds.time(kind=kind), tracing.span("media.prepare", kind=kind, bytes=len(raw)):
+        try:
+            data, mime_type = await loop.run_in_executor(_get_executor(), _PREPARERS[kind], raw)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            print(f"Media worker pool broke: {e}")
+            shutdown_media_pool()
+            raise HTTPException(status_code=503, detail="Media processing is unavailable, please retry")
+        except Exception as e:
+            print(f"Media preprocessing failed ({kind}): {e}")
+            raise HTTPException(status_code=400, detail=f"Could not read the uploaded {kind}")
+
+    media_bytes_total.inc(len(raw), kind=kind, stage="received")
+    media_bytes_total.inc(len(data), kind=kind, stage="sent")
+    return PreparedMedia(kind, data, mime_type)
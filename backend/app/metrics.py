@@ -0,0 +1,242 @@
+import time
+import threading
+from bisect import bisect_left
+
+# -----------------------------
+# Prometheus-style metrics
+# -----------------------------
+# A tiny in-process registry rendered in the Prometheus text format by
+# GET /metrics (main.py). No client library needed: counters, histograms
+# and callback gauges are enough for what we track.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _label_key(label_names, labels):
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+
+def _format_labels(label_names, key, extra=()):
+    pairs = list(zip(label_names, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.label_names, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.label_names, labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # key -> [bucket counts..., +Inf count, sum]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.label_names, labels)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        """Context manager observing the elapsed seconds of its block."""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read at scrape time from `fn`, which returns either a number or a
+    dict mapping label-value tuples to numbers.
+    """
+    def __init__(self, name, help_text, fn, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.fn = fn
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.fn()
+        except Exception as e:
+            print(f"Metrics gauge {self.name} failed: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# -----------------------------
+# Metrics tracked by the app
+# -----------------------------
+
+http_request_seconds = Histogram(
+    "clarity_http_request_seconds", "HTTP request latency by route.",
+    labels=("method", "route", "status")
+)
+
+gemini_request_seconds = Histogram(
+    "clarity_gemini_request_seconds", "Latency of single Gemini HTTP calls.",
+    labels=("module", "status")
+)
+gemini_model_seconds = Histogram(
+    "clarity_gemini_model_seconds", "Latency of successful Gemini calls, by routed model.",
+    labels=("model", "module")
+)
+gemini_tokens_total = Counter(
+    "clarity_gemini_tokens_total", "Gemini tokens billed, by model and kind (prompt, cached, output).",
+    labels=("model", "module", "kind")
+)
+gemini_cost_usd_total = Counter(
+    "clarity_gemini_cost_usd_total", "Estimated Gemini spend in USD, from token usage and GEMINI_MODEL_PRICES.",
+    labels=("model", "module")
+)
+gemini_retries_total = Counter(
+    "clarity_gemini_retries_total", "Gemini calls retried, by the status that caused the retry.",
+    labels=("module", "status")
+)
+gemini_hedges_total = Counter(
+    "clarity_gemini_hedges_total", "Hedged Gemini requests sent, and how many of them won.",
+    labels=("module", "outcome")
+)
+gemini_breaker_rejections_total = Counter(
+    "clarity_gemini_breaker_rejections_total", "Gemini calls skipped because the circuit breaker was open.",
+    labels=("module",)
+)
+ai_cache_lookups_total = Counter(
+    "clarity_ai_cache_lookups_total", "Response cache lookups by result (memory_hit, db_hit, miss).",
+    labels=("result",)
+)
+ai_requests_coalesced_total = Counter(
+    "clarity_ai_requests_coalesced_total", "Tasker/reader AI requests that joined an in-flight identical call."
+)
+chat_greetings_total = Counter(
+    "clarity_chat_greetings_total", "Chat greetings served, by source (prefetched, pool, generated, failed).",
+    labels=("source",)
+)
+chat_context_tokens = Histogram(
+    "clarity_chat_context_tokens", "Estimated tokens sent per chat request (instruction, summary, history, message).",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000)
+)
+chat_summaries_total = Counter(
+    "clarity_chat_summaries_total", "Rolling chat summary updates, by outcome.",
+    labels=("outcome",)
+)
+context_cache_total = Counter(
+    "clarity_context_cache_total", "Gemini context cache use: hit, inline, created, refreshed, failed, rejected.",
+    labels=("module", "outcome")
+)
+rate_limited_total = Counter(
+    "clarity_rate_limited_total", "Requests refused with 429 by the per-client rate limits.",
+    labels=("limit",)
+)
+similarity_lookups_total = Counter(
+    "clarity_similarity_lookups_total", "Near-duplicate lookups for tasker/reader inputs, by outcome.",
+    labels=("kind", "outcome")
+)
+ai_fallback_total = Counter(
+    "clarity_ai_fallback_total", "Requests answered with the built-in fallback response.",
+    labels=("module",)
+)
+
+db_query_seconds = Histogram(
+    "clarity_db_query_seconds", "SQL statement execution time.",
+    labels=("operation",)
+)
+db_query_errors_total = Counter(
+    "clarity_db_query_errors_total", "SQL statements that raised (constraint violations, locked database, ...).",
+    labels=("operation",)
+)
+db_commit_seconds = Histogram(
+    "clarity_db_commit_seconds", "Session commit time (flush + COMMIT)."
+)
+db_pool_wait_seconds = Histogram(
+    "clarity_db_pool_wait_seconds", "Time spent waiting to check a connection out of the pool."
+)
+db_pool_held_seconds = Histogram(
+    "clarity_db_pool_held_seconds", "Time a connection stays checked out."
+)
+
+media_prepare_seconds = Histogram(
+    "clarity_media_prepare_seconds", "Image/audio preprocessing time in the process pool.",
+    labels=("kind",)
+)
+media_bytes_total = Counter(
+    "clarity_media_bytes_total", "Image/audio bytes received from clients and sent to Gemini.",
+    labels=("kind", "stage")
+)
+
+jobs_total = Counter(
+    "clarity_jobs_total", "Background jobs by kind and final status (queued, done, failed, rejected).",
+    labels=("kind", "status")
+)
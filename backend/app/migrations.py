@@ -0,0 +1,120 @@
+from datetime import datetime
+
+# -----------------------------
+# Schema migrations
+# -----------------------------
+# Base.metadata.create_all() creates missing tables but never changes
+# existing ones, so every later schema change to app.db is listed here.
+# Each migration runs once, in its own transaction, in version order, and
+# is recorded in the schema_migrations table. A step is either a SQL
+# string or a callable taking the connection. Steps must be idempotent
+# (IF NOT EXISTS etc.), because on a fresh database create_all() has
+# already built the current schema.
+
+
+def _column_names(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def add_column(table, column, ddl):
+    """Step that adds a column unless it is already there."""
+    def step(conn):
+        if column not in _column_names(conn, table):
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return step
+
+
+def add_fts_index(table, columns, key="id"):
+    """
+    Step that creates an external-content FTS5 index `{table}_fts` over
+    `columns`, triggers that keep it in sync with the table, and indexes
+    the rows already there.
+    """
+    fts = f"{table}_fts"
+    cols = ", ".join(columns)
+    new = ", ".join(f"new.{c}" for c in columns)
+    old = ", ".join(f"old.{c}" for c in columns)
+    delete_old = f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{key}, {old});"
+    insert_new = f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.{key}, {new});"
+
+    def step(conn):
+        conn.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, "
+            f"content='{table}', content_rowid='{key}', tokenize='porter unicode61 remove_diacritics 2')"
+        )
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN {insert_new} END")
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN {delete_old} END")
+        # Only edits of indexed columns touch the index (not e.g. tasks.status)
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} "
+            f"BEGIN {delete_old} {insert_new} END"
+        )
+        conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    return step
+
+
+MIGRATIONS = [
+    (1, "lookup indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_tasks_session_id ON tasks (session_id)",
+        "CREATE INDEX IF NOT EXISTS ix_task_steps_task_id_step_index ON task_steps (task_id, step_index)",
+        "CREATE INDEX IF NOT EXISTS ix_reader_sessions_session_id ON reader_sessions (session_id)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_session_id_created_at ON chat_messages (session_id, created_at)",
+    ]),
+    (2, "chat session summaries", [
+        add_column("chat_sessions", "summary", "TEXT"),
+        add_column("chat_sessions", "summary_message_id", "INTEGER"),
+    ]),
+    (3, "job progress", [
+        add_column("jobs", "progress", "VARCHAR"),
+    ]),
+    (4, "similarity signatures", [
+        add_column("tasks", "minhash", "BLOB"),
+        add_column("reader_sessions", "minhash", "BLOB"),
+    ]),
+    (5, "full-text search", [
+        add_fts_index("chat_messages", ["message_text"]),
+        add_fts_index("tasks", ["task_title", "input_data"]),
+        add_fts_index("reader_sessions", ["input_text", "output_text"]),
+        # A match in a task title counts double
+        "INSERT INTO tasks_fts(tasks_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')",
+    ]),
+    (6, "job leases", [
+        add_column("jobs", "updated_at", "DATETIME"),
+        "UPDATE jobs SET updated_at = COALESCE(started_at, created_at) WHERE updated_at IS NULL",
+    ]),
+    (7, "chat fallback replies", [
+        add_column("chat_messages", "fallback", "BOOLEAN NOT NULL DEFAULT 0"),
+        # The canned replies of app/chatbot.py, stored before they were flagged
+        "UPDATE chat_messages SET fallback = 1 WHERE sender = 'ai' AND message_text IN ("
+        "'Configuration Error: GEMINI_API_KEY is missing from the environment.', "
+        "'The assistant is temporarily unavailable. Please try again later.', "
+        "'I''m sorry, I couldn''t formulate a response.')",
+    ]),
+]
+
+
+def run_migrations(engine):
+    """Applies all pending migrations. Called from init_db() on startup."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "name VARCHAR NOT NULL, "
+            "applied_at DATETIME NOT NULL)"
+        )
+        applied = {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+    for version, name, steps in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.exec_driver_sql(step)
+            conn.exec_driver_sql(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.utcnow().isoformat(sep=" "))
+            )
+        print(f"Applied migration {version}: {name}")
@@ -1,65 +1,168 @@
+import re
 import uuid
 import json
-import httpx
 import os
 import asyncio
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, UploadFile
 from pydantic import BaseModel
 from fastapi.responses import JSONResponse
 from pathlib import Path
-from sqlalchemy.orm import Session
-from app.database import SessionLocal, ReaderSession, get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import context_cache
+from app.gemini import call_priority, model_url
+from app.routing import route_model
+from app.metrics import ai_fallback_total
+from app.prompts import build_system_instruction, prompt_version
+from app.cache import response_cache, make_cache_key
+from app.singleflight import ai_requests
+from app.database import AsyncSessionLocal, ReaderSession, get_db
+from app.jobs import job_queue, register_job_handler
+from app.rate_limit import limit_bulk
+from app.media import media_kind, decode_upload, check_upload, read_upload, describe_upload, prepare_media
+from app.similarity import signature_for, find_similar, index_signature
 
 router = APIRouter()
 
 # --- Configuration ---
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
 API_KEY = os.getenv("GEMINI_API_KEY", "")
-# Directory to source paragraph-specific prompts
-PROMPTS_DIR = os.path.join("prompts", "paragraph")
-COMMON_PROMPTS_FILE = os.path.join("prompts", "common.txt")
-
-# --- Helper Logic ---
-def load_custom_prompts():
-    """Reads prompts/common.txt and all .txt files from prompts/paragraph directory."""
-    custom_prompts = []
-    
-    # Load common prompts first
-    if os.path.exists(COMMON_PROMPTS_FILE):
-        try:
-            with open(COMMON_PROMPTS_FILE, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                if content:
-                    custom_prompts.append(content)
-        except Exception as e:
-            print(f"Error reading common prompts file: {e}")
-    
-    # Load module-specific prompts
-    if os.path.exists(PROMPTS_DIR) and os.path.isdir(PROMPTS_DIR):
-        for filename in os.listdir(PROMPTS_DIR):
-            if filename.endswith(".txt"):
-                file_path = os.path.join(PROMPTS_DIR, filename)
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read().strip()
-                        if content:
-                            custom_prompts.append(content)
-                except Exception as e:
-                    print(f"Error reading prompt file {filename}: {e}")
-    return "\n\n".join(custom_prompts)
+
+# Inputs longer than one chunk are explained in parallel, chunk by chunk
+READER_CHUNK_CHARS = int(os.getenv("READER_CHUNK_CHARS", "6000"))
+READER_CHUNK_FANOUT = int(os.getenv("READER_CHUNK_FANOUT", "4"))
 
 # --- Request Schemas ---
 class ReaderInput(BaseModel):
     input_method: str  # paragraph | audio | image
-    input_data: str
+    input_data: str    # text, or a base64 file for audio/image
+
+MEDIA_PROMPTS = {
+    "image": "Please explain the text or topic in this image in a simple, sensory-friendly way.",
+    "audio": "Please explain the topic of this recording in a simple, sensory-friendly way.",
+}
 
 # --- AI Logic ---
-async def call_gemini_explainer(input_text: str):
+async def _request_explanation(model: str, payload: dict):
+    """Posts the payload to Gemini under the shared retry policy. Returns the parsed JSON output or None."""
+    response = await context_cache.generate_content("paragraph", model, f"{model_url(model)}?key={API_KEY}", payload)
+    if response is None:
+        return None
+    try:
+        result = response.json()
+        content = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+        return json.loads(content)
+    except (ValueError, IndexError, AttributeError) as e:
+        print(f"Gemini API Error: unreadable response: {e}")
+        return None
+
+def split_into_chunks(text: str, max_chars: int = READER_CHUNK_CHARS):
+    """
+    Packs whole paragraphs into chunks of at most max_chars. Only a paragraph
+    that is longer than a chunk on its own is cut, at a sentence end if possible.
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        paragraph = paragraph.strip()
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(". ", 0, max_chars)
+            cut = cut + 1 if cut > max_chars // 2 else max_chars
+            pieces.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            pieces.append(paragraph)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 2 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _explanation_payload(system_instruction: str, prompt: str, media=None):
+    parts = [{"text": prompt}]
+    if media is not None:
+        parts.append(media.part())
+    return {
+        "contents": [{"parts": parts}],
+        "systemInstruction": {"parts": [{"text": system_instruction}]},
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": {
+                "type": "OBJECT",
+                "properties": {
+                    "title": {"type": "STRING"},
+                    "explanation": {"type": "STRING"}
+                },
+                "required": ["title", "explanation"]
+            }
+        }
+    }
+
+async def _explain_chunk(system_instruction: str, chunk: str, index: int, total: int):
+    """Explains one part of a long text. Parts are cached on their own, so a retry only redoes failed parts."""
+    prompt = (
+        f"This is part {index} of {total} of a longer text. "
+        f"Please explain this part in a simple, sensory-friendly way:\n\n{chunk}"
+    )
+    model = route_model("paragraph", len(chunk), structured=True)
+    cache_key = make_cache_key("paragraph", model, system_instruction, prompt)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    ai_output = await _request_explanation(model, _explanation_payload(system_instruction, prompt))
+    if isinstance(ai_output, dict) and ai_output.get("explanation"):
+        await response_cache.set(cache_key, "paragraph", ai_output)
+        return ai_output
+    return None
+
+async def _explain_long(system_instruction: str, input_text: str, progress=None):
+    """
+    Explains a long text as parallel chunk requests (at most READER_CHUNK_FANOUT
+    at a time) and merges them into one title/explanation. Returns
+    (output, complete); output is None when every chunk failed.
+    """
+    chunks = split_into_chunks(input_text)
+    slots = asyncio.Semaphore(READER_CHUNK_FANOUT)
+    finished = 0
+
+    async def explain(index, chunk):
+        nonlocal finished
+        async with slots:
+            output = await _explain_chunk(system_instruction, chunk, index, len(chunks))
+        finished += 1
+        if progress is not None:
+            await progress(finished, len(chunks))
+        return output
+
+    outputs = await asyncio.gather(*(explain(i, chunk) for i, chunk in enumerate(chunks, 1)))
+    if not any(outputs):
+        return None, False
+
+    sections = []
+    for index, output in enumerate(outputs, 1):
+        if output:
+            sections.append(f"{output.get('title') or f'Part {index}'}\n\n{output['explanation']}")
+        else:
+            sections.append(f"Part {index}\n\n• We couldn't simplify this part right now. Please try again in a moment.")
+
+    title = next(output.get("title") for output in outputs if output) or "Topic Explanation"
+    return {"title": title, "explanation": "\n\n".join(sections)}, all(outputs)
+
+async def call_gemini_explainer(input_text: str, progress=None, media=None):
     """
     Calls Gemini to explain a topic in a sensory-friendly, simplified way.
     Returns a clear explanation with structured points.
     Sources additional context from the prompts/paragraph directory.
+    Long inputs are split into chunks; `progress(done, total)` is awaited
+    as chunks complete. With `media` (a prepared image/audio file) the file
+    is explained instead of input_text.
     """
     base_instruction = (
         "You are a sensory-safe reading assistant. Your goal is to explain topics in a clear, "
@@ -71,94 +174,170 @@ async def call_gemini_explainer(input_text: str):
     )
     
     # Dynamic prompt sourcing
-    custom_context = load_custom_prompts()
-    full_system_instruction = base_instruction
-    if custom_context:
-        full_system_instruction += "\n\nADDITIONAL CONTEXT AND GUIDELINES:\n" + custom_context
-    
-    payload = {
-        "contents": [{"parts": [{"text": f"Please explain this topic in a simple, sensory-friendly way:\n\n{input_text}"}]}],
-        "systemInstruction": {"parts": [{"text": full_system_instruction}]},
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": {
-                "type": "OBJECT",
-                "properties": {
-                    "title": {"type": "STRING"},
-                    "explanation": {"type": "STRING"}
-                },
-                "required": ["title", "explanation"]
-            }
-        }
-    }
+    full_system_instruction = build_system_instruction("paragraph", base_instruction)
+    # Long texts are routed chunk by chunk in _explain_chunk
+    model = route_model("paragraph", len(input_text), structured=True, media=media)
+
+    # Identical input + prompt + model always yields a reusable answer
+    cache_key = make_cache_key(
+        "paragraph", model, full_system_instruction, media.digest() if media is not None else input_text
+    )
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    async def generate(shared_progress):
+        if media is None and len(input_text) > READER_CHUNK_CHARS:
+            ai_output, complete = await _explain_long(full_system_instruction, input_text, shared_progress)
+            if ai_output is None:
+                # Every chunk failed: the fallback below answers
+                return None
+            # A merge with failed parts is returned but not cached
+            if complete:
+                await response_cache.set(cache_key, "paragraph", ai_output)
+            else:
+                ai_output["fallback"] = True
+            return ai_output
+
+        if media is not None:
+            payload = _explanation_payload(full_system_instruction, MEDIA_PROMPTS[media.kind], media)
+        else:
+            payload = _explanation_payload(
+                full_system_instruction,
+                f"Please explain this topic in a simple, sensory-friendly way:\n\n{input_text}"
+            )
+        ai_output = await _request_explanation(model, payload)
+        if isinstance(ai_output, dict) and ai_output.get("explanation"):
+            await response_cache.set(cache_key, "paragraph", ai_output)
+            return ai_output
+        return None
 
-    async with httpx.AsyncClient() as client:
-        for attempt in range(5):
-            try:
-                response = await client.post(
-                    f"{GEMINI_API_URL}?key={API_KEY}",
-                    json=payload,
-                    timeout=20.0
-                )
-                if response.status_code == 200:
-                    result = response.json()
-                    content = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-                    return json.loads(content)
-                
-                if response.status_code in [429, 500, 503]:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                break
-            except Exception as e:
-                print(f"Gemini API Error: {e}")
-                await asyncio.sleep(2 ** attempt)
+    # Concurrent identical requests of the same priority share a single
+    # upstream call; each caller still gets the chunk progress
+    ai_output = await ai_requests.do((call_priority("paragraph"), cache_key), generate, progress)
+    if ai_output is not None:
+        return ai_output
 
     # Fallback if AI fails completely
+    ai_fallback_total.inc(module="paragraph")
     return {
         "title": "Topic Explanation",
-        "explanation": "• We couldn't process your request right now.\n\n• Please try again in a moment.\n\n• The text you provided was: " + input_text[:100]
+        "explanation": "• We couldn't process your request right now.\n\n• Please try again in a moment.\n\n• The text you provided was: " + input_text[:100],
+        "fallback": True
     }
 
+def similarity_scope(input_text: str):
+    model = route_model("paragraph", len(input_text), structured=True)
+    return f"{model}:{prompt_version('paragraph')}"
+
+async def find_similar_reading(input_text: str):
+    """
+    (output, signature): the explanation of an earlier session whose input
+    is a near-duplicate of this one (or None), and the input's signature.
+    """
+    signature = await signature_for(input_text)
+    if signature is None:
+        return None, None
+
+    async with AsyncSessionLocal() as db:
+        session = await find_similar(db, "reader", similarity_scope(input_text), signature, ReaderSession)
+    if session is None:
+        return None, signature
+
+    # output_text is stored as "# title\n\nexplanation"
+    heading, _, explanation = session.output_text.partition("\n\n")
+    return {"title": heading.removeprefix("# "), "explanation": explanation}, signature
+
 # --- Routes ---
 
 # Legacy HTML route removed - Flutter is the frontend
 
-@router.post("/api/reader/input")
-async def process_reader_input(data: ReaderInput, db: Session = Depends(get_db)):
+async def run_reader_input(input_method: str, input_data: str, progress=None):
     """
-    Called by input.html when module=paragraph. 
-    Triggers AI to explain the topic, saves to DB, and returns session_id.
+    Triggers AI to explain the topic, saves the reader session and returns
+    the response body. Shared by the route and the background job worker.
     """
-    # 1. AI Content Generation
-    ai_output = await call_gemini_explainer(data.input_data)
+    # 1. Image/audio input is shrunk off the event loop; only a short
+    # description of the file is stored with the session
+    media = None
+    kind = media_kind(input_method)
+    if kind is not None:
+        raw = decode_upload(input_data)
+        media = await prepare_media(kind, raw)
+        input_data = describe_upload(kind, raw)
+
+    # 2. A near-duplicate of an earlier text input reuses its explanation,
+    # otherwise AI Content Generation (no DB session is open while waiting)
+    ai_output, signature = (None, None) if media is not None else await find_similar_reading(input_data)
+    if ai_output is None:
+        ai_output = await call_gemini_explainer(input_data, progress, media)
+    else:
+        # Indexed once, so reuse cannot drift away from the original input
+        signature = None
     
-    # 2. Generate Session ID
+    # 3. Generate Session ID
     session_id = str(uuid.uuid4())
     
-    # 3. Format output text with title
+    # 4. Format output text with title
     output_text = f"# {ai_output.get('title', 'Topic Explanation')}\n\n{ai_output.get('explanation', '')}"
     
-    # 4. Store in DB
+    # 5. Store in DB
     new_session = ReaderSession(
         session_id=session_id,
-        input_method=data.input_method,
-        input_text=data.input_data,
+        input_method=input_method,
+        input_text=input_data,
         output_text=output_text
     )
-    db.add(new_session)
-    db.commit()
+    async with AsyncSessionLocal() as db:
+        db.add(new_session)
+        # Fallback text is not worth finding again
+        if signature is not None and not ai_output.get("fallback"):
+            await db.flush()
+            index_signature(db, "reader", similarity_scope(input_data), new_session, signature)
+        await db.commit()
 
     return {
         "session_id": session_id,
-        "input_method": data.input_method,
+        "input_method": input_method,
         "title": ai_output.get("title", "Topic Explanation"),
         "output_text": ai_output.get("explanation", "")
     }
 
+register_job_handler("reader", lambda payload, progress: run_reader_input(**payload, progress=progress))
+
+@router.post("/api/reader/input", dependencies=[Depends(limit_bulk)])
+async def process_reader_input(data: ReaderInput, async_mode: bool = Query(False, alias="async")):
+    """
+    Called by input.html when module=paragraph. 
+    Triggers AI to explain the topic, saves to DB, and returns session_id.
+    With ?async=true it answers 202 with a job id to poll at /api/jobs/{job_id}.
+    """
+    if async_mode:
+        check_upload(data.input_method, data.input_data)
+        job_id = await job_queue.submit("reader", data.model_dump())
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}
+        )
+    return await run_reader_input(data.input_method, data.input_data)
+
+@router.post("/api/reader/upload", dependencies=[Depends(limit_bulk)])
+async def upload_reader_input(
+    input_method: str = Form(...),
+    file: UploadFile = File(...),
+    async_mode: bool = Query(False, alias="async")
+):
+    """Multipart variant of /api/reader/input for image and audio files."""
+    if media_kind(input_method) is None:
+        raise HTTPException(status_code=400, detail="Uploads need input_method audio or image")
+    data = ReaderInput(input_method=input_method, input_data=await read_upload(file))
+    return await process_reader_input(data, async_mode)
+
 @router.get("/api/reader/details/{session_id}")
-async def get_reader_details(session_id: str, db: Session = Depends(get_db)):
+async def get_reader_details(session_id: str, db: AsyncSession = Depends(get_db)):
     """Used by paragraph.html to fetch and render the saved content."""
-    session = db.query(ReaderSession).filter(ReaderSession.session_id == session_id).first()
+    result = await db.execute(select(ReaderSession).where(ReaderSession.session_id == session_id))
+    session = result.scalars().first()
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -169,9 +348,10 @@ async def get_reader_details(session_id: str, db: Session = Depends(get_db)):
     }
 
 @router.post("/api/paragraph/done/{session_id}")
-async def paragraph_done(session_id: str, db: Session = Depends(get_db)):
+async def paragraph_done(session_id: str, db: AsyncSession = Depends(get_db)):
     """Mark the reading session as complete."""
-    session = db.query(ReaderSession).filter(ReaderSession.session_id == session_id).first()
+    result = await db.execute(select(ReaderSession).where(ReaderSession.session_id == session_id))
+    session = result.scalars().first()
     if not session:
         return {"status": "error", "message": "Session not found"}
     return {"status": "ok"}
@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+from app import tracing
+
+# -----------------------------
+# Prompt registry
+# -----------------------------
+# Composes prompts/common.txt + prompts/<module>/*.txt once per module and
+# keeps the result in memory. The files are only re-stat'ed every
+# PROMPT_CHECK_INTERVAL seconds, and re-read only when a file was added,
+# removed or modified. settings.update_user_profile invalidates explicitly.
+
+PROMPTS_ROOT = "prompts"
+COMMON_PROMPTS_FILE = os.path.join(PROMPTS_ROOT, "common.txt")
+PROMPT_CHECK_INTERVAL = float(os.getenv("PROMPT_CHECK_INTERVAL", "2"))
+
+
+class _PromptEntry:
+    def __init__(self, signature, text):
+        self.signature = signature
+        self.text = text
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        self.checked_at = time.monotonic()
+
+
+class PromptRegistry:
+    def __init__(self, root=PROMPTS_ROOT, check_interval=PROMPT_CHECK_INTERVAL):
+        self.root = root
+        self.check_interval = check_interval
+        self._entries = {}
+
+    def _sources(self, module):
+        """common.txt first, then the module's .txt files in name order."""
+        sources = [os.path.join(self.root, "common.txt")]
+        module_dir = os.path.join(self.root, module)
+        if os.path.isdir(module_dir):
+            sources += [
+                os.path.join(module_dir, name)
+                for name in sorted(os.listdir(module_dir))
+                if name.endswith(".txt")
+            ]
+        return sources
+
+    def _signature(self, module):
+        signature = []
+        module_dir = os.path.join(self.root, module)
+        try:
+            signature.append((module_dir, os.stat(module_dir).st_mtime_ns))
+        except OSError:
+            signature.append((module_dir, None))
+
+        for path in self._sources(module):
+            try:
+                st = os.stat(path)
+                signature.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append((path, None))
+        return tuple(signature)
+
+    def _read(self, module):
+        custom_prompts = []
+        for path in self._sources(module):
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    content = f.read().strip()
+                    if content:
+                        custom_prompts.append(content)
+            except Exception as e:
+                print(f"Error reading prompt file {path}: {e}")
+        return "\n\n".join(custom_prompts)
+
+    def _entry(self, module):
+        entry = self._entries.get(module)
+        now = time.monotonic()
+        if entry is not None and now - entry.checked_at < self.check_interval:
+            return entry
+
+        signature = self._signature(module)
+        if entry is not None and entry.signature == signature:
+            entry.checked_at = now
+            return entry
+
+        entry = _PromptEntry(signature, self._read(module))
+        self._entries[module] = entry
+        return entry
+
+    def get(self, module):
+        """Returns the joined custom prompts for a module."""
+        return self._entry(module).text
+
+    def version(self, module):
+        """Short content hash of the module's prompts, changes on every edit."""
+        return self._entry(module).version
+
+    def invalidate(self, module=None):
+        """Drops cached prompts for one module, or all of them."""
+        if module is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(module, None)
+
+
+registry = PromptRegistry()
+
+
+def build_system_instruction(module, base_instruction):
+    """Appends the module's custom prompts to its base system instruction."""
+    with tracing.span("prompt.build", module=module):
+        custom_context = registry.get(module)
+    if custom_context:
+        return base_instruction + "\n\nADDITIONAL CONTEXT AND GUIDELINES:\n" + custom_context
+    return base_instruction
+
+
+def prompt_version(module):
+    return registry.version(module)
+
+
+def invalidate_prompts(module=None):
+    registry.invalidate(module)
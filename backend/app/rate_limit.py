@@ -0,0 +1,139 @@
+import os
+import math
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request
+from app.metrics import rate_limited_total
+
+# -----------------------------
+# Per-client rate limiting
+# -----------------------------
+# Token buckets keyed by client address, so one client looping
+# /api/tasker/start cannot use up the Gemini quota everybody shares.
+# A request over its limit is answered with 429 and a Retry-After
+# telling the client when the next one will be accepted.
+# Anything the client sends about itself can be changed on every
+# request, so it never replaces the address: chat messages are limited
+# per session and per address.
+#
+# Behind proxies the peer address is the proxy's, shared by every user.
+# Set RATE_LIMIT_PROXY_HOPS to the number of proxies in front of the app
+# that append to X-Forwarded-For (1 for Cloud Run or a single load
+# balancer); the address is then the entry the outermost of them added,
+# counted from the right. Entries further left are written by the client.
+# Requests with an X-Forwarded-For while RATE_LIMIT_PROXY_HOPS=0 log a
+# warning, since all of them would share one bucket.
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate        # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Takes one token. Returns 0 if allowed, else seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, name, per_minute, burst, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> TokenBucket, least recently used first
+
+    def check(self, key: str):
+        """Seconds the caller has to wait, 0 when the request may go ahead."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            # Idle keys are refilled anyway, the oldest can simply be forgotten
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(now)
+
+
+chat_limiter = RateLimiter(
+    "chat",
+    float(os.getenv("RATE_LIMIT_CHAT_PER_MINUTE", "20")),
+    float(os.getenv("RATE_LIMIT_CHAT_BURST", "5"))
+)
+chat_client_limiter = RateLimiter(
+    "chat_client",
+    float(os.getenv("RATE_LIMIT_CHAT_CLIENT_PER_MINUTE", "60")),
+    float(os.getenv("RATE_LIMIT_CHAT_CLIENT_BURST", "15"))
+)
+session_limiter = RateLimiter(
+    "session",
+    float(os.getenv("RATE_LIMIT_SESSIONS_PER_MINUTE", "10")),
+    float(os.getenv("RATE_LIMIT_SESSIONS_BURST", "5"))
+)
+bulk_limiter = RateLimiter(
+    "bulk",
+    float(os.getenv("RATE_LIMIT_BULK_PER_MINUTE", "10")),
+    float(os.getenv("RATE_LIMIT_BULK_BURST", "5"))
+)
+
+
+_proxy_warned = False
+
+
+def client_key(request: Request):
+    global _proxy_warned
+    forwarded = request.headers.get("x-forwarded-for")
+    if RATE_LIMIT_PROXY_HOPS and forwarded:
+        hops = [hop.strip() for hop in forwarded.split(",")]
+        if len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return hops[-RATE_LIMIT_PROXY_HOPS]
+    elif forwarded and RATE_LIMIT_ENABLED and not _proxy_warned:
+        _proxy_warned = True
+        print(
+            "WARNING: requests arrive through a proxy (X-Forwarded-For) but RATE_LIMIT_PROXY_HOPS=0, "
+            "so every client shares the proxy's rate limit buckets. Set RATE_LIMIT_PROXY_HOPS to the "
+            "number of proxies in front of the app, or RATE_LIMIT_ENABLED=0."
+        )
+    return request.client.host if request.client else "unknown"
+
+
+def enforce_rate_limit(limiter: RateLimiter, key: str):
+    """Raises 429 with Retry-After when `key` is over the limiter's rate."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    wait = limiter.check(key)
+    if wait > 0:
+        rate_limited_total.inc(limit=limiter.name)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please slow down",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))}
+        )
+
+
+# Route dependencies, e.g. @router.post(..., dependencies=[Depends(limit_bulk)])
+def limit_bulk(request: Request):
+    enforce_rate_limit(bulk_limiter, client_key(request))
+
+
+def limit_sessions(request: Request):
+    enforce_rate_limit(session_limiter, client_key(request))
+
+
+def limit_chat(request: Request, session_id: str):
+    """Chat messages: a new session id does not get the client a new budget."""
+    enforce_rate_limit(chat_client_limiter, client_key(request))
+    enforce_rate_limit(chat_limiter, session_id)
@@ -0,0 +1,97 @@
+import os
+import json
+from app import metrics
+
+# -----------------------------
+# Model routing
+# -----------------------------
+# Picks the Gemini model for each request instead of sending everything
+# to one tier: greetings, chat summaries and short task deconstructions
+# go to the lite model, large reader requests to a bigger one, the rest
+# to GEMINI_DEFAULT_MODEL. The first rule of the routing table that
+# matches wins. A rule can match on:
+#   module      "tasker", "paragraph", "chatbot", "chatbot_greeting", "chatbot_summary"
+#   min_chars / max_chars   length of the request's input text
+#   structured  true for JSON (responseSchema) output, false for free text
+#   media       true for image/audio input, false for text
+# Replace the table with GEMINI_ROUTES='[{"module": "tasker", "model": "..."}, ...]'.
+# Per-model latency, tokens and estimated cost are exported on /metrics.
+
+GEMINI_DEFAULT_MODEL = os.getenv("GEMINI_DEFAULT_MODEL", "gemini-2.0-flash")
+GEMINI_LITE_MODEL = os.getenv("GEMINI_LITE_MODEL", "gemini-2.0-flash-lite")
+GEMINI_LARGE_MODEL = os.getenv("GEMINI_LARGE_MODEL", "gemini-2.5-flash")
+
+DEFAULT_ROUTES = [
+    {"module": "chatbot_greeting", "model": GEMINI_LITE_MODEL},
+    {"module": "chatbot_summary", "model": os.getenv("CHAT_SUMMARY_MODEL", GEMINI_LITE_MODEL)},
+    {"module": "tasker", "media": False, "max_chars": 1500, "model": GEMINI_LITE_MODEL},
+    # Whole texts up to READER_CHUNK_CHARS and the chunks of longer ones
+    {"module": "paragraph", "media": False, "min_chars": 4000, "model": GEMINI_LARGE_MODEL},
+]
+
+# USD per 1M tokens: (prompt, output, cached prompt). Override with
+# GEMINI_MODEL_PRICES='{"model": [prompt, output, cached], ...}'
+DEFAULT_PRICES = {
+    "gemini-2.0-flash-lite": (0.075, 0.30, 0.075),
+    "gemini-2.0-flash": (0.10, 0.40, 0.025),
+    "gemini-2.5-flash-lite": (0.10, 0.40, 0.025),
+    "gemini-2.5-flash": (0.30, 2.50, 0.075),
+    "gemini-2.5-pro": (1.25, 10.00, 0.31),
+}
+
+
+def _load_json(name, default):
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError as e:
+        print(f"Ignoring invalid {name}: {e}")
+        return default
+
+
+ROUTES = _load_json("GEMINI_ROUTES", DEFAULT_ROUTES)
+MODEL_PRICES = {**DEFAULT_PRICES, **{m: tuple(p) for m, p in _load_json("GEMINI_MODEL_PRICES", {}).items()}}
+
+
+def _matches(rule, module, chars, structured, media):
+    if "module" in rule and rule["module"] != module:
+        return False
+    if "min_chars" in rule and chars < rule["min_chars"]:
+        return False
+    if "max_chars" in rule and chars > rule["max_chars"]:
+        return False
+    if "structured" in rule and rule["structured"] != structured:
+        return False
+    if "media" in rule and rule["media"] != (media is not None):
+        return False
+    return True
+
+
+def route_model(module: str, chars: int = 0, structured: bool = False, media=None):
+    """The model for one request: the first matching ROUTES rule, else GEMINI_DEFAULT_MODEL."""
+    for rule in ROUTES:
+        if _matches(rule, module, chars, structured, media):
+            return rule["model"]
+    return GEMINI_DEFAULT_MODEL
+
+
+def record_usage(module: str, model: str, usage: dict):
+    """Counts the tokens of one response (its usageMetadata) and their estimated cost."""
+    if not usage:
+        return
+    prompt = usage.get("promptTokenCount", 0)
+    cached = usage.get("cachedContentTokenCount", 0)
+    # Thinking tokens (2.5 models) are billed as output
+    output = usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0)
+
+    metrics.gemini_tokens_total.inc(prompt - cached, model=model, module=module, kind="prompt")
+    metrics.gemini_tokens_total.inc(cached, model=model, module=module, kind="cached")
+    metrics.gemini_tokens_total.inc(output, model=model, module=module, kind="output")
+
+    prices = MODEL_PRICES.get(model)
+    if prices is not None:
+        prompt_price, output_price, cached_price = prices
+        cost = ((prompt - cached) * prompt_price + cached * cached_price + output * output_price) / 1_000_000
+        metrics.gemini_cost_usd_total.inc(cost, model=model, module=module)
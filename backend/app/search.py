@@ -0,0 +1,193 @@
+import os
+import re
+import sys
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_db
+
+router = APIRouter()
+
+# -----------------------------
+# Full-text search
+# -----------------------------
+# Chat messages, tasks and reader sessions are indexed in FTS5 tables
+# (chat_messages_fts, tasks_fts, reader_sessions_fts, see migration 5).
+# They are external-content tables, so the text is not stored twice, and
+# triggers keep them in sync on every insert/update/delete. A search asks
+# each index for its best offset+limit matches by bm25 rank, merges them
+# and builds snippets only for the returned page, so the cost depends on
+# the page and the number of matches, not on the size of app.db.
+# Sessions are private to whoever holds their UUID, so a search only
+# covers the sessions the caller names (session_id, repeatable).
+#
+# Existing databases are indexed by the migration; to rebuild the
+# indexes (e.g. after editing app.db by hand) and merge their b-trees:
+#     python -m app.search rebuild
+
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "8"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "500"))
+SEARCH_SNIPPET_TOKENS = int(os.getenv("SEARCH_SNIPPET_TOKENS", "16"))
+SEARCH_MAX_SESSIONS = int(os.getenv("SEARCH_MAX_SESSIONS", "50"))
+
+# Result type -> FTS5 table
+SEARCH_INDEXES = {
+    "chat": "chat_messages_fts",
+    "task": "tasks_fts",
+    "reader": "reader_sessions_fts",
+}
+
+# Best matches of one index within the caller's sessions
+_RANKED = """
+    SELECT {fts}.rowid, {fts}.rank FROM {fts} JOIN {table} ON {table}.id = {fts}.rowid
+    WHERE {fts} MATCH :q AND {table}.session_id IN :sids
+    ORDER BY {fts}.rank LIMIT :window
+"""
+
+_TERM = re.compile(r"\w+")
+
+
+def fts_query(q: str):
+    """
+    Turns free text into an FTS5 query: every word must match, the last
+    one as a prefix (search-as-you-type). None when there are no words.
+    Quoting each word keeps FTS5 operators and punctuation in user input
+    from being parsed as query syntax.
+    """
+    terms = _TERM.findall(q)[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms) + "*"
+
+
+def _snippet(table: str, column: int = -1):
+    return f"snippet({table}, {column}, '**', '**', '…', {SEARCH_SNIPPET_TOKENS})"
+
+
+# Page rows -> result fields, joined on the rowids of the chosen matches
+_DETAILS = {
+    "chat": f"""
+        SELECT m.id, m.session_id, m.sender AS title, m.created_at, {_snippet("chat_messages_fts", 0)} AS snippet
+        FROM chat_messages_fts JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+        WHERE chat_messages_fts MATCH :q AND chat_messages_fts.rowid IN :ids
+    """,
+    "task": f"""
+        SELECT t.id, t.session_id, t.task_title AS title, t.created_at, {_snippet("tasks_fts")} AS snippet
+        FROM tasks_fts JOIN tasks t ON t.id = tasks_fts.rowid
+        WHERE tasks_fts MATCH :q AND tasks_fts.rowid IN :ids
+    """,
+    # output_text starts with "# title"
+    "reader": f"""
+        SELECT r.id, r.session_id, substr(r.output_text, 1, 200) AS title, r.created_at,
+               {_snippet("reader_sessions_fts")} AS snippet
+        FROM reader_sessions_fts JOIN reader_sessions r ON r.id = reader_sessions_fts.rowid
+        WHERE reader_sessions_fts MATCH :q AND reader_sessions_fts.rowid IN :ids
+    """,
+}
+
+
+def _title(kind, value):
+    if kind == "reader":
+        return (value or "").split("\n", 1)[0].removeprefix("# ").strip()
+    return value
+
+
+async def search(db: AsyncSession, q: str, session_ids, kinds, limit: int, offset: int):
+    """(results, has_more) for one page of matches in `session_ids` across `kinds`, best first."""
+    query = fts_query(q)
+    if query is None:
+        return [], False
+
+    # Best offset+limit+1 of every index; bm25 ranks from different
+    # indexes are close enough to merge on
+    window = offset + limit + 1
+    ranked = []
+    for kind in kinds:
+        fts = SEARCH_INDEXES[kind]
+        statement = text(_RANKED.format(fts=fts, table=fts.removesuffix("_fts")))
+        result = await db.execute(
+            statement.bindparams(bindparam("sids", expanding=True)),
+            {"q": query, "sids": session_ids, "window": window}
+        )
+        ranked.extend((rank, kind, rowid) for rowid, rank in result.all())
+    ranked.sort()
+    page = ranked[offset:offset + limit]
+
+    details = {}
+    for kind in kinds:
+        ids = [rowid for _, k, rowid in page if k == kind]
+        if not ids:
+            continue
+        statement = text(_DETAILS[kind]).bindparams(bindparam("ids", expanding=True)).columns(created_at=DateTime)
+        result = await db.execute(statement, {"q": query, "ids": ids})
+        for row in result.mappings():
+            details[(kind, row["id"])] = row
+
+    results = []
+    for rank, kind, rowid in page:
+        row = details.get((kind, rowid))
+        if row is None:
+            # Deleted between the two queries
+            continue
+        results.append({
+            "type": kind,
+            "id": rowid,
+            "session_id": row["session_id"],
+            "title": _title(kind, row["title"]),
+            "snippet": row["snippet"],
+            "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+            "score": round(-rank, 4),
+        })
+    return results, len(ranked) > offset + limit
+
+
+@router.get("/api/search")
+async def search_content(
+    q: str = Query(..., min_length=1, max_length=200),
+    session_id: list[str] = Query(..., description="Sessions to search, repeatable"),
+    types: str = Query("chat,task,reader", description="Comma-separated: chat, task, reader"),
+    limit: int = Query(20, ge=1, le=50),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Ranked full-text search over the chat messages, tasks and reader
+    sessions of the given sessions. Snippets mark matched words with **.
+    Page with offset/limit while has_more is true.
+    """
+    kinds = [kind.strip() for kind in types.split(",") if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in SEARCH_INDEXES]
+    if unknown or not kinds:
+        raise HTTPException(status_code=400, detail=f"types must be a subset of {', '.join(SEARCH_INDEXES)}")
+
+    session_ids = list(dict.fromkeys(sid for sid in session_id if sid))
+    if not session_ids or len(session_ids) > SEARCH_MAX_SESSIONS:
+        raise HTTPException(status_code=400, detail=f"Pass 1 to {SEARCH_MAX_SESSIONS} session_id values")
+
+    results, has_more = await search(db, q, session_ids, kinds, limit, offset)
+    return {
+        "query": q,
+        "results": results,
+        "limit": limit,
+        "offset": offset,
+        "has_more": has_more,
+    }
+
+
+def rebuild_search_indexes(engine, optimize=True):
+    """Re-reads every indexed table into its FTS5 index and merges its b-trees."""
+    with engine.begin() as conn:
+        for table in SEARCH_INDEXES.values():
+            conn.exec_driver_sql(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+            if optimize:
+                conn.exec_driver_sql(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+            print(f"Rebuilt {table}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("Usage: python -m app.search rebuild")
+    from app.database import engine, init_db
+    # Applies pending migrations first, which creates the indexes if needed
+    init_db()
+    rebuild_search_indexes(engine)
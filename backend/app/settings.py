@@ -3,6 +3,8 @@ from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import HTMLResponse
 from pathlib import Path
 from pydantic import BaseModel
+from app.prompts import invalidate_prompts
+from app.chatbot import greetings
 
 router = APIRouter()
 
@@ -77,6 +79,11 @@ async def update_user_profile(data: UserProfileUpdate):
         with open(COMMON_PROMPTS_FILE, "w", encoding="utf-8") as f:
             f.write(new_content)
         
+        # Composed system instructions embed common.txt, rebuild them
+        invalidate_prompts()
+        # Pooled greetings were written for the old profile
+        greetings.refresh()
+        
         return {"status": "ok", "message": "Profile updated successfully"}
     
     except Exception as e:
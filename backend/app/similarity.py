@@ -0,0 +1,139 @@
+import os
+import re
+import random
+import struct
+import asyncio
+import hashlib
+from sqlalchemy import select
+from app import tracing
+from app.metrics import similarity_lookups_total
+from app.database import SimilarityBucket
+
+# -----------------------------
+# Near-duplicate inputs
+# -----------------------------
+# The response cache only helps when a paste is identical to an earlier
+# one. Students paste the same assignment or chapter with a different
+# heading, a fixed typo or one extra sentence, so tasker and reader inputs
+# also get a MinHash signature over word 3-grams, stored on the Task /
+# ReaderSession row. The signature is split into LSH bands; every band is
+# hashed into a similarity_buckets row, so finding candidates is an
+# indexed lookup of a few buckets instead of a scan of all past sessions.
+# A candidate whose estimated Jaccard similarity reaches
+# SIMILARITY_THRESHOLD has its stored output reused. Buckets are scoped by
+# model and prompt version, so a prompt or profile change stops reuse.
+
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "1") == "1"
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.9"))
+# Shorter inputs are left to the exact-match response cache
+SIMILARITY_MIN_WORDS = int(os.getenv("SIMILARITY_MIN_WORDS", "20"))
+SIMILARITY_MAX_CANDIDATES = int(os.getenv("SIMILARITY_MAX_CANDIDATES", "20"))
+
+SHINGLE_WORDS = 3
+NUM_PERM = 64
+# 16 bands of 4 rows: pairs at 0.9 similarity share a bucket >99.9% of the
+# time, pairs at 0.5 about 64%, which the exact signature comparison weeds out
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5EED)   # fixed, stored signatures must stay comparable
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+_PACK = struct.Struct(f"<{NUM_PERM}Q")
+_WORD = re.compile(r"\w+")
+
+
+def _hash64(data: bytes):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def shingles(text: str):
+    words = _WORD.findall(text.lower())
+    if len(words) < SIMILARITY_MIN_WORDS:
+        return set()
+    return {
+        _hash64(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+
+
+def minhash(text: str):
+    """MinHash signature of the text, None when it is too short to compare."""
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(x == y for x, y in zip(first, second)) / NUM_PERM
+
+
+def pack(signature):
+    return _PACK.pack(*signature)
+
+
+def unpack(data: bytes):
+    return list(_PACK.unpack(data))
+
+
+def band_buckets(kind: str, scope: str, signature):
+    """One bucket per LSH band, as signed 64-bit ints for the SQLite column."""
+    buckets = []
+    for band in range(BANDS):
+        values = signature[band * ROWS:(band + 1) * ROWS]
+        material = f"{kind}|{scope}|{band}|" + ",".join(map(str, values))
+        buckets.append(_hash64(material.encode("utf-8")) - (1 << 63))
+    return buckets
+
+
+async def signature_for(text: str):
+    """Computes the signature off the event loop; None if disabled or too short."""
+    if not SIMILARITY_ENABLED:
+        return None
+    with tracing.span("similarity.signature", chars=len(text)):
+        return await asyncio.to_thread(minhash, text)
+
+
+async def find_similar(db, kind: str, scope: str, signature, model):
+    """
+    The most similar earlier `model` row (Task or ReaderSession) at or above
+    SIMILARITY_THRESHOLD, or None.
+    """
+    with tracing.span("similarity.lookup", kind=kind) as span:
+        best = await _find_similar(db, kind, scope, signature, model)
+        span.set(hit=best is not None)
+        return best
+
+
+async def _find_similar(db, kind, scope, signature, model):
+    buckets = band_buckets(kind, scope, signature)
+    result = await db.execute(
+        select(SimilarityBucket.row_id)
+        .where(SimilarityBucket.kind == kind, SimilarityBucket.bucket.in_(buckets))
+        .distinct()
+        .order_by(SimilarityBucket.row_id.desc())
+        .limit(SIMILARITY_MAX_CANDIDATES)
+    )
+    row_ids = result.scalars().all()
+    if not row_ids:
+        similarity_lookups_total.inc(kind=kind, outcome="miss")
+        return None
+
+    result = await db.execute(select(model).where(model.id.in_(row_ids), model.minhash.is_not(None)))
+    best, best_score = None, SIMILARITY_THRESHOLD
+    for row in result.scalars():
+        score = similarity(signature, unpack(row.minhash))
+        if score >= best_score:
+            best, best_score = row, score
+
+    similarity_lookups_total.inc(kind=kind, outcome="hit" if best is not None else "miss")
+    return best
+
+
+def index_signature(db, kind: str, scope: str, row, signature):
+    """Stores the signature on a flushed row and adds its buckets to the session."""
+    row.minhash = pack(signature)
+    for bucket in band_buckets(kind, scope, signature):
+        db.add(SimilarityBucket(kind=kind, bucket=bucket, row_id=row.id))
@@ -0,0 +1,81 @@
+import asyncio
+from app import metrics
+
+# -----------------------------
+# Single-flight request coalescing
+# -----------------------------
+# Concurrent callers asking for the same key share one upstream call.
+# The first caller starts it as a task; later callers just await it.
+# A caller that is cancelled (e.g. client disconnect) only stops waiting,
+# the shared call keeps running for the others and is cancelled only
+# once nobody is waiting for it any more.
+#
+# Keys must include everything that changes how the call is made, not just
+# what it returns: callers build them with the upstream priority class so
+# a background job never joins (and drags down) an interactive request.
+#
+# Progress reported by the shared call goes to every waiter's `progress`
+# callback; a caller that joins late first gets the latest report.
+
+
+class _Flight:
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.listeners = []
+        self.last_progress = None
+
+    async def report(self, done: int, total: int):
+        self.last_progress = (done, total)
+        for listener in list(self.listeners):
+            try:
+                await listener(done, total)
+            except Exception as e:
+                # One waiter's failing callback must not fail the shared call
+                print(f"Single-flight progress callback failed: {e}")
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key, fn, progress=None):
+        """
+        Runs `fn(progress)` (a coroutine function) once per key among
+        concurrent callers and returns its result to all of them. The
+        `progress(done, total)` it is given forwards to every caller's own
+        `progress`. Exceptions raised by `fn` propagate to every waiting
+        caller.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(fn(flight.report))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self._flights[key] = flight
+        else:
+            metrics.ai_requests_coalesced_total.inc()
+
+        flight.waiters += 1
+        if progress is not None:
+            flight.listeners.append(progress)
+        try:
+            if progress is not None and flight.last_progress is not None:
+                await progress(*flight.last_progress)
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if progress is not None:
+                flight.listeners.remove(progress)
+
+
+# Shared by tasker and paragraph; keys are (priority class, response cache key)
+ai_requests = SingleFlight()
@@ -1,63 +1,59 @@
 import uuid
 import json
-import httpx
 import os
-import asyncio
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, Request, UploadFile
 from pydantic import BaseModel
 from fastapi.responses import JSONResponse
 from pathlib import Path
-from sqlalchemy.orm import Session
-from app.database import SessionLocal, Task, TaskStep, get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import context_cache
+from app.gemini import call_priority, model_url
+from app.routing import route_model
+from app.metrics import ai_fallback_total
+from app.prompts import build_system_instruction, prompt_version
+from app.cache import response_cache, make_cache_key
+from app.singleflight import ai_requests
+from app.database import AsyncSessionLocal, Task, TaskStep, get_db
+from app.jobs import job_queue, register_job_handler
+from app.rate_limit import limit_bulk
+from app.media import media_kind, decode_upload, check_upload, read_upload, describe_upload, prepare_media
+from app.similarity import signature_for, find_similar, index_signature
 
 router = APIRouter()
 
 # --- Configuration ---
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
 API_KEY = os.getenv("GEMINI_API_KEY", "")
-# Directory to source tasker-specific prompts
-PROMPTS_DIR = os.path.join("prompts", "tasker")
-COMMON_PROMPTS_FILE = os.path.join("prompts", "common.txt")
 
 # --- Request Schemas ---
 class TaskStartRequest(BaseModel):
     input_method: str  # paragraph | audio | image
-    input_data: str
+    input_data: str    # text, or a base64 file for audio/image
 
-# --- Helper Logic ---
-def load_custom_prompts():
-    """Reads prompts/common.txt and all .txt files from prompts/tasker directory."""
-    custom_prompts = []
-    
-    # Load common prompts first
-    if os.path.exists(COMMON_PROMPTS_FILE):
-        try:
-            with open(COMMON_PROMPTS_FILE, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                if content:
-                    custom_prompts.append(content)
-        except Exception as e:
-            print(f"Error reading common prompts file: {e}")
-    
-    # Load module-specific prompts
-    if os.path.exists(PROMPTS_DIR) and os.path.isdir(PROMPTS_DIR):
-        for filename in os.listdir(PROMPTS_DIR):
-            if filename.endswith(".txt"):
-                file_path = os.path.join(PROMPTS_DIR, filename)
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read().strip()
-                        if content:
-                            custom_prompts.append(content)
-                except Exception as e:
-                    print(f"Error reading prompt file {filename}: {e}")
-    return "\n\n".join(custom_prompts)
+MEDIA_PROMPTS = {
+    "image": "Deconstruct the assignment or task shown in this image.",
+    "audio": "Deconstruct the task described in this recording.",
+}
 
 # --- AI Logic ---
-async def call_gemini_deconstructor(input_text: str):
+async def _request_deconstruction(model: str, payload: dict):
+    """Posts the payload to Gemini under the shared retry policy. Returns the parsed JSON output or None."""
+    response = await context_cache.generate_content("tasker", model, f"{model_url(model)}?key={API_KEY}", payload)
+    if response is None:
+        return None
+    try:
+        result = response.json()
+        content = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+        return json.loads(content)
+    except (ValueError, IndexError, AttributeError) as e:
+        print(f"Gemini API Error: unreadable response: {e}")
+        return None
+
+async def call_gemini_deconstructor(input_text: str, media=None):
     """
-    Calls Gemini to deconstruct text into a title and action steps.
+    Calls Gemini to deconstruct text (or a prepared image/audio file) into
+    a title and action steps.
     Sources additional context from the models/tasker directory.
     """
     # Base instructions for the AI
@@ -69,13 +65,15 @@ async def call_gemini_deconstructor(input_text: str):
     )
 
     # Dynamic prompt sourcing
-    custom_context = load_custom_prompts()
-    full_system_instruction = base_instruction
-    if custom_context:
-        full_system_instruction += "\n\nADDITIONAL CONTEXT AND GUIDELINES:\n" + custom_context
+    full_system_instruction = build_system_instruction("tasker", base_instruction)
+    model = route_model("tasker", len(input_text), structured=True, media=media)
     
+    parts = [{"text": input_text}]
+    if media is not None:
+        parts = [{"text": MEDIA_PROMPTS[media.kind]}, media.part()]
+
     payload = {
-        "contents": [{"parts": [{"text": input_text}]}],
+        "contents": [{"parts": parts}],
         "systemInstruction": { "parts": [{ "text": full_system_instruction }] },
         "generationConfig": {
             "responseMimeType": "application/json",
@@ -93,75 +91,121 @@ async def call_gemini_deconstructor(input_text: str):
         }
     }
 
-    async with httpx.AsyncClient() as client:
-        for attempt in range(5):
-            try:
-                response = await client.post(
-                    f"{GEMINI_API_URL}?key={API_KEY}",
-                    json=payload,
-                    timeout=20.0
-                )
-                if response.status_code == 200:
-                    result = response.json()
-                    content = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-                    return json.loads(content)
-                
-                if response.status_code in [429, 500, 503]:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                break
-            except Exception as e:
-                print(f"Gemini API Error: {e}")
-                await asyncio.sleep(2 ** attempt)
+    # Identical input + prompt + model always yields a reusable answer
+    cache_key = make_cache_key(
+        "tasker", model, full_system_instruction, media.digest() if media is not None else input_text
+    )
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    async def generate(_progress):
+        ai_output = await _request_deconstruction(model, payload)
+        if isinstance(ai_output, dict) and ai_output.get("steps"):
+            await response_cache.set(cache_key, "tasker", ai_output)
+            return ai_output
+        return None
+
+    # Concurrent identical requests of the same priority share a single upstream call
+    ai_output = await ai_requests.do((call_priority("tasker"), cache_key), generate)
+    if ai_output is not None:
+        return ai_output
 
     # Fallback if AI fails completely
+    ai_fallback_total.inc(module="tasker")
     return {
         "title": "New Task",
-        "steps": ["Review your notes", "Identify primary goal", "Break down actions", "Execute first step"]
+        "steps": ["Review your notes", "Identify primary goal", "Break down actions", "Execute first step"],
+        "fallback": True
     }
 
+def similarity_scope(input_data: str):
+    model = route_model("tasker", len(input_data), structured=True)
+    return f"{model}:{prompt_version('tasker')}"
+
+async def find_similar_task(input_data: str):
+    """
+    (output, signature): the title and steps of an earlier task whose input
+    is a near-duplicate of this one (or None), and the input's signature.
+    """
+    signature = await signature_for(input_data)
+    if signature is None:
+        return None, None
+
+    async with AsyncSessionLocal() as db:
+        task = await find_similar(db, "tasker", similarity_scope(input_data), signature, Task)
+        if task is None:
+            return None, signature
+        result = await db.execute(
+            select(TaskStep.step_text).where(TaskStep.task_id == task.id).order_by(TaskStep.step_index)
+        )
+        steps = result.scalars().all()
+
+    if not steps:
+        return None, signature
+    return {"title": task.task_title, "steps": steps}, signature
+
 # --- Routes ---
 
 # Legacy HTML route removed - Flutter is the frontend
 
-@router.post("/api/tasker/start")
-async def start_task_deconstruction(data: TaskStartRequest, db: Session = Depends(get_db)):
+async def run_task_deconstruction(input_method: str, input_data: str):
     """
-    Called by input.html. Triggers AI with custom prompts, saves to DB, 
-    and returns the session_id.
+    Triggers AI with custom prompts, saves the task and its steps and returns
+    the response body. Shared by the route and the background job worker.
     """
-    # 1. AI Content Generation
-    ai_output = await call_gemini_deconstructor(data.input_data)
+    # 1. Image/audio input is shrunk off the event loop; only a short
+    # description of the file is stored with the task
+    media = None
+    kind = media_kind(input_method)
+    if kind is not None:
+        raw = decode_upload(input_data)
+        media = await prepare_media(kind, raw)
+        input_data = describe_upload(kind, raw)
+
+    # 2. A near-duplicate of an earlier text input reuses its steps,
+    # otherwise AI Content Generation (no DB session is open while waiting)
+    ai_output, signature = (None, None) if media is not None else await find_similar_task(input_data)
+    if ai_output is None:
+        ai_output = await call_gemini_deconstructor(input_data, media)
+    else:
+        # Indexed once, so reuse cannot drift away from the original input
+        signature = None
     
-    # 2. Generate Session and Task Record
+    # 3. Generate Session and Task Record
     session_id = str(uuid.uuid4())
     
-    new_task = Task(
-        session_id=session_id,
-        input_method=data.input_method,
-        input_data=data.input_data,
-        task_title=ai_output.get("title", "Task Deconstruction"),
-        status="active",
-        created_at=datetime.utcnow()
-    )
-    db.add(new_task)
-    db.flush() 
-
-    # 3. Save Steps individually
-    steps_data = []
-    for i, step_text in enumerate(ai_output.get("steps", []), 1):
-        new_step = TaskStep(
-            task_id=new_task.id,
-            step_index=i,
-            step_text=step_text,
-            is_completed=False,
+    async with AsyncSessionLocal() as db:
+        new_task = Task(
+            session_id=session_id,
+            input_method=input_method,
+            input_data=input_data,
+            task_title=ai_output.get("title", "Task Deconstruction"),
             status="active",
             created_at=datetime.utcnow()
         )
-        db.add(new_step)
-        steps_data.append({"step_index": i, "step_text": step_text})
-    
-    db.commit()
+        db.add(new_task)
+        await db.flush()
+
+        # 4. Save Steps individually
+        steps_data = []
+        for i, step_text in enumerate(ai_output.get("steps", []), 1):
+            new_step = TaskStep(
+                task_id=new_task.id,
+                step_index=i,
+                step_text=step_text,
+                is_completed=False,
+                status="active",
+                created_at=datetime.utcnow()
+            )
+            db.add(new_step)
+            steps_data.append({"step_index": i, "step_text": step_text})
+
+        # Fallback steps are not worth finding again
+        if signature is not None and not ai_output.get("fallback"):
+            index_signature(db, "tasker", similarity_scope(input_data), new_task, signature)
+        
+        await db.commit()
 
     return {
         "session_id": session_id,
@@ -169,14 +213,46 @@ async def start_task_deconstruction(data: TaskStartRequest, db: Session = Depend
         "steps": steps_data
     }
 
+register_job_handler("tasker", lambda payload, progress: run_task_deconstruction(**payload))
+
+@router.post("/api/tasker/start", dependencies=[Depends(limit_bulk)])
+async def start_task_deconstruction(data: TaskStartRequest, async_mode: bool = Query(False, alias="async")):
+    """
+    Called by input.html. Triggers AI with custom prompts, saves to DB, 
+    and returns the session_id.
+    With ?async=true it answers 202 with a job id to poll at /api/jobs/{job_id}.
+    """
+    if async_mode:
+        check_upload(data.input_method, data.input_data)
+        job_id = await job_queue.submit("tasker", data.model_dump())
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}
+        )
+    return await run_task_deconstruction(data.input_method, data.input_data)
+
+@router.post("/api/tasker/upload", dependencies=[Depends(limit_bulk)])
+async def upload_task_input(
+    input_method: str = Form(...),
+    file: UploadFile = File(...),
+    async_mode: bool = Query(False, alias="async")
+):
+    """Multipart variant of /api/tasker/start for image and audio files."""
+    if media_kind(input_method) is None:
+        raise HTTPException(status_code=400, detail="Uploads need input_method audio or image")
+    data = TaskStartRequest(input_method=input_method, input_data=await read_upload(file))
+    return await start_task_deconstruction(data, async_mode)
+
 @router.get("/api/tasker/details/{session_id}")
-async def get_task_details(session_id: str, db: Session = Depends(get_db)):
+async def get_task_details(session_id: str, db: AsyncSession = Depends(get_db)):
     """Used by tasker.html to fetch and render the saved data."""
-    task = db.query(Task).filter(Task.session_id == session_id).first()
+    result = await db.execute(select(Task).where(Task.session_id == session_id))
+    task = result.scalars().first()
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    steps = db.query(TaskStep).filter(TaskStep.task_id == task.id).order_by(TaskStep.step_index).all()
+    result = await db.execute(select(TaskStep).where(TaskStep.task_id == task.id).order_by(TaskStep.step_index))
+    steps = result.scalars().all()
     
     return {
         "task_title": task.task_title,
@@ -184,12 +260,13 @@ async def get_task_details(session_id: str, db: Session = Depends(get_db)):
     }
 
 @router.post("/api/tasker/done/{session_id}")
-async def tasker_done(session_id: str, db: Session = Depends(get_db)):
-    task = db.query(Task).filter(Task.session_id == session_id).first()
+async def tasker_done(session_id: str, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(Task).where(Task.session_id == session_id))
+    task = result.scalars().first()
     if not task:
         return {"status": "error", "message": "Task not found"}
     
     task.status = "completed"
     task.completed_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
     return {"status": "ok"}
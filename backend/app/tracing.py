@@ -0,0 +1,239 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+import contextvars
+
+# -----------------------------
+# Request tracing
+# -----------------------------
+# OpenTelemetry-style spans without the SDK. The middleware in main.py
+# opens a root span per request (job runs get one too) and returns its
+# trace id in the X-Trace-Id header. Prompt assembly, cache lookups, every
+# Gemini attempt, slot wait and retry sleep, and every DB statement and
+# commit record child spans under it, through a ContextVar.
+# Finished traces are
+#   - exported when sampled (TRACE_SAMPLE_RATE): TRACE_EXPORTER=file
+#     appends one JSON line per trace to TRACE_FILE, =console prints the
+#     span tree
+#   - printed as a span tree when slower than TRACE_SLOW_SECONDS
+#     (a TRACE_SLOW_SAMPLE_RATE share of them, to keep logs readable)
+# A client may send its own X-Trace-Id (32 hex digits) to correlate logs.
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()   # none | console | file
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "5"))
+TRACE_SLOW_SAMPLE_RATE = float(os.getenv("TRACE_SLOW_SAMPLE_RATE", "1.0"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))
+
+_TRACE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+
+def valid_trace_id(value):
+    return bool(value) and _TRACE_ID.match(value) is not None
+
+
+class Trace:
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled   # exported; slow traces are logged either way
+        self.spans = []          # finished spans, the root last
+        self.dropped = 0
+        self.finished = False
+
+
+class Span:
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.error = None
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def end(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        trace = self.trace
+        # Spans of background tasks that outlive the request are dropped
+        if trace.finished:
+            return
+        if len(trace.spans) < TRACE_MAX_SPANS:
+            trace.spans.append(self)
+        else:
+            trace.dropped += 1
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.end(exc)
+        return False
+
+
+class _NoopSpan:
+    """Stands in for a span when no trace is active (startup, scripts)."""
+
+    def set(self, **attributes):
+        return self
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def start_trace(name, trace_id=None, **attributes):
+    """
+    Root span of a new trace. Make it current with `token = activate(root)`
+    and hand it to finish_trace() when the work is done.
+    """
+    trace = Trace(trace_id or new_trace_id(), random.random() < TRACE_SAMPLE_RATE)
+    return Span(trace, name, attributes=attributes)
+
+
+def activate(span):
+    return _current.set(span)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def start_span(name, **attributes):
+    """Child span of the current one, ended by the caller; not made current."""
+    parent = _current.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def span(name, **attributes):
+    """`with span("db.save"):` records a child span of the current one."""
+    return start_span(name, **attributes)
+
+
+def create_background_task(coro):
+    """
+    asyncio.create_task() outside the current trace, for work the request
+    does not wait for (summaries, greeting prefetch, cache creation).
+    """
+    context = contextvars.copy_context()
+    context.run(_current.set, None)
+    return asyncio.create_task(coro, context=context)
+
+
+def finish_trace(root, error=None):
+    """Ends the root span, then exports and/or logs the trace."""
+    root.end(error)
+    trace = root.trace
+    trace.finished = True
+    try:
+        if trace.sampled and TRACE_EXPORTER == "file":
+            _write_line(json.dumps(trace_to_dict(trace), ensure_ascii=False))
+        elif trace.sampled and TRACE_EXPORTER == "console":
+            print(format_tree(trace))
+        if root.duration >= TRACE_SLOW_SECONDS and random.random() < TRACE_SLOW_SAMPLE_RATE:
+            print(f"Slow request ({root.duration:.2f}s, threshold {TRACE_SLOW_SECONDS}s):\n{format_tree(trace)}")
+    except Exception as e:
+        print(f"Trace export failed: {e}")
+
+
+def span_to_dict(span):
+    return {
+        "spanId": span.span_id,
+        "parentSpanId": span.parent_id,
+        "name": span.name,
+        "startTime": span.start_time,
+        "durationMs": round(span.duration * 1000, 3),
+        "attributes": span.attributes,
+        "status": "error" if span.error else "ok",
+        **({"error": span.error} if span.error else {}),
+    }
+
+
+def trace_to_dict(trace):
+    root = trace.spans[-1]
+    return {
+        "traceId": trace.trace_id,
+        "name": root.name,
+        "durationMs": round(root.duration * 1000, 3),
+        "droppedSpans": trace.dropped,
+        "spans": [span_to_dict(span) for span in trace.spans],
+    }
+
+
+def format_tree(trace):
+    """Indented span tree: offset from the request start, duration, name, attributes."""
+    root = trace.spans[-1]
+    children = {}
+    for span in trace.spans[:-1]:
+        children.setdefault(span.parent_id, []).append(span)
+
+    lines = [f"trace {trace.trace_id}"]
+
+    def add(span, depth):
+        offset = (span.start_time - root.start_time) * 1000
+        attributes = " ".join(f"{key}={value}" for key, value in span.attributes.items())
+        error = f" ERROR {span.error}" if span.error else ""
+        lines.append(
+            f"{'  ' * depth}+{offset:8.1f}ms {span.duration * 1000:9.1f}ms  {span.name} {attributes}{error}".rstrip()
+        )
+        for child in sorted(children.get(span.span_id, []), key=lambda s: s.start_time):
+            add(child, depth + 1)
+
+    add(root, 0)
+    if trace.dropped:
+        lines.append(f"({trace.dropped} more spans dropped)")
+    return "\n".join(lines)
+
+
+_file_lock = threading.Lock()
+_file = None
+
+
+def _write_line(line):
+    global _file
+    with _file_lock:
+        if _file is None:
+            _file = open(TRACE_FILE, "a", encoding="utf-8")
+        _file.write(line + "\n")
+        _file.flush()
+
+
+def close_exporter():
+    global _file
+    with _file_lock:
+        if _file is not None:
+            _file.close()
+            _file = None
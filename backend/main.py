@@ -5,23 +5,52 @@ This is a pure API server for the Flutter frontend.
 All responses are JSON. No HTML rendering.
 """
 
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 # Load environment variables BEFORE importing app modules
 load_dotenv()
 
-from app import tasker, paragraph, chatbot, settings
-from app.database import init_db
+from app import tasker, paragraph, chatbot, settings, gemini, metrics, jobs, search, tracing
+from app.chat_writer import chat_writer
+from app.jobs import job_queue
+from app.chat_context import stop_summaries
+from app.media import shutdown_media_pool
+from app.context_cache import context_cache
+from app.database import init_db, async_engine
 
 # Initialize database
 init_db()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens shared resources on startup and releases them on shutdown."""
+    await gemini.start_client()
+    await chat_writer.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await chatbot.greetings.stop()
+    await stop_summaries()
+    shutdown_media_pool()
+    await context_cache.stop()
+    # Flush queued chat messages before the engine goes away
+    await chat_writer.stop()
+    await gemini.close_client()
+    await async_engine.dispose()
+    tracing.close_exporter()
+
+
 app = FastAPI(
     title="Clarity API",
     description="REST API for Clarity Flutter app",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware for Flutter Web & Android
@@ -31,13 +60,71 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "Retry-After"],
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Per-route latency histogram, labelled with the route template."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status
+        )
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """Root span per request; the trace ends when the response body is sent."""
+    incoming = request.headers.get("x-trace-id", "").lower()
+    root = tracing.start_trace(
+        f"{request.method} {request.url.path}",
+        trace_id=incoming if tracing.valid_trace_id(incoming) else None,
+        method=request.method
+    )
+    token = tracing.activate(root)
+    try:
+        response = await call_next(request)
+    except Exception as e:
+        tracing.finish_trace(root, e)
+        raise
+    finally:
+        tracing.deactivate(token)
+
+    route = request.scope.get("route")
+    if route is not None:
+        root.name = f"{request.method} {route.path}"
+    root.set(status=response.status_code)
+    response.headers["X-Trace-Id"] = root.trace.trace_id
+
+    # Streaming replies (chat) are still running here
+    body = response.body_iterator
+
+    async def traced_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            tracing.finish_trace(root)
+
+    response.body_iterator = traced_body()
+    return response
+
 # Mount API Routers
 app.include_router(tasker.router)
 app.include_router(paragraph.router)
 app.include_router(chatbot.router)
 app.include_router(settings.router)
+app.include_router(jobs.router)
+app.include_router(search.router)
 
 
 @app.get("/")
@@ -46,6 +133,12 @@ async def root():
     return {"status": "ok", "message": "Clarity API is running"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5050)
@@ -0,0 +1,162 @@
+"""
+End-to-end load test for the Clarity API.
+
+Drives the chat, tasker and reader flows (including the details
+endpoints) at a fixed concurrency and reports latency percentiles and
+throughput per endpoint. Run it against a backend that points at
+tools/mock_gemini.py so results do not depend on the real API.
+
+Usage:
+    python tools/mock_gemini.py --port 8090 &
+    GEMINI_API_URL=http://127.0.0.1:8090/v1beta GEMINI_API_KEY=test python main.py &
+    python tools/benchmark.py --concurrency 32 --duration 30 --mix chat=2,tasker=1,reader=1
+
+All workers share one address, so the per-client rate limits would
+throttle the whole run: start the backend with RATE_LIMIT_ENABLED=0.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+SAMPLE_TEXT = (
+    "Write a 1500 word essay on the causes of the First World War. Use at least three "
+    "primary sources, include a bibliography in APA format and submit it as a PDF by Friday."
+)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, client, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[name] += 1
+            return None
+        return response
+
+
+def make_text(unique):
+    # Unique inputs defeat the response cache; shared ones exercise it
+    return f"{SAMPLE_TEXT} [{uuid.uuid4()}]" if unique else SAMPLE_TEXT
+
+
+async def chat_flow(client, rec, args):
+    response = await rec.call(client, "POST /api/chat/start", "POST", "/api/chat/start")
+    if response is None:
+        return
+    session_id = response.json()["session_id"]
+    if args.stream:
+        await rec.call(client, "POST /api/chat/message/stream", "POST", "/api/chat/message/stream",
+                       json={"session_id": session_id, "message": make_text(True)})
+    else:
+        await rec.call(client, "POST /api/chat/message", "POST", "/api/chat/message",
+                       json={"session_id": session_id, "message": make_text(True)})
+
+
+async def tasker_flow(client, rec, args):
+    response = await rec.call(client, "POST /api/tasker/start", "POST", "/api/tasker/start",
+                              json={"input_method": "paragraph", "input_data": make_text(args.unique)})
+    if response is None:
+        return
+    session_id = response.json()["session_id"]
+    await rec.call(client, "GET /api/tasker/details", "GET", f"/api/tasker/details/{session_id}")
+
+
+async def reader_flow(client, rec, args):
+    response = await rec.call(client, "POST /api/reader/input", "POST", "/api/reader/input",
+                              json={"input_method": "paragraph", "input_data": make_text(args.unique)})
+    if response is None:
+        return
+    session_id = response.json()["session_id"]
+    await rec.call(client, "GET /api/reader/details", "GET", f"/api/reader/details/{session_id}")
+
+
+FLOWS = {"chat": chat_flow, "tasker": tasker_flow, "reader": reader_flow}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in FLOWS:
+            raise SystemExit(f"Unknown flow '{name}', expected one of {', '.join(FLOWS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def report(rec, elapsed):
+    print(f"\n{'endpoint':<34}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+    total = 0
+    for name in sorted(set(rec.latencies) | set(rec.errors)):
+        values = sorted(rec.latencies[name])
+        total += len(values)
+        print(
+            f"{name:<34}{len(values):>8}{rec.errors[name]:>8}"
+            f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+            f"{percentile(values, 99) * 1000:>10.1f}{len(values) / elapsed:>9.1f}"
+        )
+    print(f"\n{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s overall")
+
+
+async def run(args):
+    weights = parse_mix(args.mix)
+    names, flow_weights = list(weights), list(weights.values())
+    rec = Recorder()
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = started + args.duration
+        remaining = [args.iterations]
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                if args.iterations:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                flow = FLOWS[random.choices(names, flow_weights)[0]]
+                await flow(client, rec, args)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    report(rec, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clarity API load test")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5050")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--iterations", type=int, default=0, help="stop after N flows (0 = duration only)")
+    parser.add_argument("--mix", default="chat=1,tasker=1,reader=1", help="flow weights")
+    parser.add_argument("--unique", action="store_true", help="unique tasker/reader inputs (no cache hits)")
+    parser.add_argument("--stream", action="store_true", help="use the SSE chat endpoint")
+    parser.add_argument("--timeout", type=float, default=120)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
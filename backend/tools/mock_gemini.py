@@ -0,0 +1,235 @@
+"""
+Local Gemini stand-in for load tests and benchmarks.
+
+Implements the subset of the Gemini REST API the backend uses:
+    POST /v1beta/models/{model}:generateContent
+    POST /v1beta/models/{model}:streamGenerateContent?alt=sse
+    POST/PATCH/DELETE /v1beta/cachedContents[/{id}]   (context caching)
+
+Responses follow the request's responseSchema (tasker / reader JSON) or
+are plain text (chat) and carry usageMetadata estimated at ~4 characters
+per token. Latency, error and 429 injection are configurable.
+
+Usage:
+    python tools/mock_gemini.py --port 8090 --latency-median 0.8 --rate-429 0.02
+    GEMINI_API_URL=http://127.0.0.1:8090/v1beta GEMINI_API_KEY=test python main.py
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock Gemini")
+
+# Overwritten from the command line in main()
+config = {
+    "latency_median": 0.8,     # seconds, median of a log-normal distribution
+    "latency_sigma": 0.5,      # spread; 0 gives a fixed latency
+    "latency_max": 30.0,
+    "error_rate": 0.0,         # fraction of calls answered with 500/503
+    "rate_429": 0.0,           # fraction of calls answered with 429
+    "retry_after": 1,          # Retry-After seconds sent with 429
+    "stream_chunks": 8,
+    "context_cache": True,     # False answers cachedContents calls with 400
+}
+
+stats = {"requests": 0, "errors": 0, "rate_limited": 0, "cached_requests": 0, "cached_contents": 0, "models": {}}
+
+# cachedContents/{id} -> {"model": "models/...", "expires": time.time(), "tokens": n}
+cached_contents = {}
+
+LOREM = (
+    "Take a short breath first. Start with the smallest piece you can finish in five minutes. "
+    "Write down what done looks like. Put your phone in another room. Set a timer and begin. "
+    "When the timer ends, take a break and check off what you finished."
+).split()
+
+
+def sample_latency():
+    median = config["latency_median"]
+    sigma = config["latency_sigma"]
+    if sigma <= 0:
+        return median
+    return min(random.lognormvariate(math.log(max(median, 1e-6)), sigma), config["latency_max"])
+
+
+def injected_failure():
+    """Returns an error response to send instead of a result, or None."""
+    roll = random.random()
+    if roll < config["rate_429"]:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+            headers={"Retry-After": str(config["retry_after"])}
+        )
+    if roll < config["rate_429"] + config["error_rate"]:
+        stats["errors"] += 1
+        code = random.choice([500, 503])
+        return JSONResponse(status_code=code, content={"error": {"code": code}})
+    return None
+
+
+def fake_text(words):
+    return " ".join(random.choice(LOREM) for _ in range(words))
+
+
+def fake_output(payload):
+    """Builds output text matching the requested responseSchema, if any."""
+    schema = payload.get("generationConfig", {}).get("responseSchema")
+    if not schema:
+        return fake_text(40)
+
+    properties = schema.get("properties", {})
+    result = {}
+    for name, spec in properties.items():
+        if spec.get("type") == "ARRAY":
+            result[name] = [fake_text(6) for _ in range(random.randint(5, 7))]
+        elif name == "title":
+            result[name] = fake_text(3).capitalize()
+        else:
+            result[name] = "\n\n".join("• " + fake_text(12) for _ in range(4))
+    return json.dumps(result)
+
+
+def candidate(text, usage=None):
+    result = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+    if usage is not None:
+        result["usageMetadata"] = usage
+    return result
+
+
+def estimate_tokens(value):
+    return len(json.dumps(value)) // 4
+
+
+def usage_metadata(payload, text, cached_tokens=0):
+    prompt = estimate_tokens(payload.get("contents", [])) + estimate_tokens(payload.get("systemInstruction", {}))
+    output = len(text) // 4
+    return {
+        "promptTokenCount": prompt + cached_tokens,
+        "cachedContentTokenCount": cached_tokens,
+        "candidatesTokenCount": output,
+        "totalTokenCount": prompt + cached_tokens + output,
+    }
+
+
+def parse_ttl(ttl):
+    return float(str(ttl).rstrip("s"))
+
+
+def error(code, message):
+    return JSONResponse(status_code=code, content={"error": {"code": code, "message": message}})
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cached_content(request: Request):
+    if not config["context_cache"]:
+        return error(400, "Context caching is not supported")
+    body = await request.json()
+    name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+    expires = time.time() + parse_ttl(body.get("ttl", "3600s"))
+    cached_contents[name] = {
+        "model": body.get("model"), "expires": expires, "tokens": estimate_tokens(body.get("systemInstruction", {}))
+    }
+    stats["cached_contents"] += 1
+    return {"name": name, "model": body.get("model"), "expireTime": expires}
+
+
+@app.patch("/v1beta/cachedContents/{cache_id}")
+async def update_cached_content(cache_id: str, request: Request):
+    entry = cached_contents.get(f"cachedContents/{cache_id}")
+    if entry is None or entry["expires"] < time.time():
+        return error(404, "CachedContent not found")
+    body = await request.json()
+    entry["expires"] = time.time() + parse_ttl(body.get("ttl", "3600s"))
+    return {"name": f"cachedContents/{cache_id}", "expireTime": entry["expires"]}
+
+
+@app.delete("/v1beta/cachedContents/{cache_id}")
+async def delete_cached_content(cache_id: str):
+    cached_contents.pop(f"cachedContents/{cache_id}", None)
+    return {}
+
+
+@app.post("/v1beta/models/{model_method}")
+async def generate(model_method: str, request: Request):
+    stats["requests"] += 1
+    payload = await request.json()
+    model, _, method = model_method.partition(":")
+    stats["models"][model] = stats["models"].get(model, 0) + 1
+
+    cached_tokens = 0
+    if "cachedContent" in payload:
+        entry = cached_contents.get(payload["cachedContent"])
+        if entry is None or entry["expires"] < time.time():
+            return error(404, "CachedContent not found")
+        if entry["model"] != f"models/{model}":
+            return error(400, "Model does not match the cached content")
+        stats["cached_requests"] += 1
+        cached_tokens = entry["tokens"]
+
+    await asyncio.sleep(sample_latency())
+
+    failure = injected_failure()
+    if failure is not None:
+        return failure
+
+    text = fake_output(payload)
+    usage = usage_metadata(payload, text, cached_tokens)
+    if method == "generateContent":
+        return candidate(text, usage)
+
+    if method == "streamGenerateContent":
+        words = text.split(" ")
+        size = max(1, math.ceil(len(words) / config["stream_chunks"]))
+
+        async def events():
+            for i in range(0, len(words), size):
+                last = i + size >= len(words)
+                chunk = " ".join(words[i:i + size]) + ("" if last else " ")
+                # Like Gemini, the final chunk reports the usage of the whole call
+                yield f"data: {json.dumps(candidate(chunk, usage if last else None))}\r\n\r\n"
+                await asyncio.sleep(0.02)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return error(404, f"Unknown method {method}")
+
+
+@app.get("/stats")
+async def get_stats():
+    return {**stats, "config": config}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Gemini stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-median", type=float, default=config["latency_median"])
+    parser.add_argument("--latency-sigma", type=float, default=config["latency_sigma"])
+    parser.add_argument("--latency-max", type=float, default=config["latency_max"])
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"])
+    parser.add_argument("--rate-429", type=float, default=config["rate_429"])
+    parser.add_argument("--retry-after", type=int, default=config["retry_after"])
+    parser.add_argument("--stream-chunks", type=int, default=config["stream_chunks"])
+    parser.add_argument("--no-context-cache", dest="context_cache", action="store_false",
+                        help="refuse cachedContents calls")
+    args = parser.parse_args()
+
+    for key in config:
+        config[key] = getattr(args, key)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()